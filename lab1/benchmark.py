@@ -0,0 +1,223 @@
+import argparse
+import heapq
+import itertools
+import json
+import os
+import random
+import selectors
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+HEADER = struct.Struct('!cII')  # Same header as in server.py and client/client.py
+RECV_BUF_SIZE = 65536
+LAB_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVER_PATH = os.path.join(LAB_DIR, 'server.py')
+CLIENT_PATH = os.path.join(LAB_DIR, 'client', 'client.py')
+
+
+def parse_size(value):
+    # Accepts sizes like 512K, 10M or 1G
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+    if value[-1].upper() in units:
+        return int(float(value[:-1]) * units[value[-1].upper()])
+    return int(value)
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+
+class LossyProxy(threading.Thread):
+    # UDP proxy between the client and the server that drops, duplicates, delays and reorders datagrams
+    # in both directions. It also matches data chunks with their ACKs to measure ACK latency.
+    def __init__(self, server_addr, loss, duplicate, reorder, delay, jitter):
+        super().__init__(daemon=True)
+        self.server_addr = server_addr
+        self.loss, self.duplicate, self.reorder = loss, duplicate, reorder
+        self.delay, self.jitter = delay, jitter
+        self.selector = selectors.DefaultSelector()
+        self.socket = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
+        self.socket.bind(('127.0.0.1', 0))
+        self.selector.register(self.socket, selectors.EVENT_READ, None)
+        self.upstream = {}  # client addr -> socket towards the server
+        self.queue = []  # (delivery time, order, socket, data, addr)
+        self.order = itertools.count()
+        self.running = True
+
+        self.sent_at = {}  # data seqno -> time the latest copy was forwarded
+        self.seen = set()
+        self.ack_latencies = []
+        self.counters = {'forwarded': 0, 'dropped': 0, 'duplicated': 0, 'reordered': 0, 'retransmissions': 0}
+
+    @property
+    def addr(self):
+        return self.socket.getsockname()
+
+    def schedule(self, sock, data, addr):
+        if random.random() < self.loss:
+            self.counters['dropped'] += 1
+            return
+        copies = 2 if random.random() < self.duplicate else 1
+        self.counters['duplicated'] += copies - 1
+        for _ in range(copies):
+            delay = self.delay + random.uniform(0, self.jitter)
+            if random.random() < self.reorder:
+                # Holding the datagram back so that the following ones overtake it
+                delay += max(self.delay, 0.001) * 2
+                self.counters['reordered'] += 1
+            heapq.heappush(self.queue, (time.monotonic() + delay, next(self.order), sock, data, addr))
+
+    def track(self, data, from_client):
+        if len(data) < HEADER.size:
+            return
+        message_type, seqno, _ = HEADER.unpack_from(data)
+        now = time.monotonic()
+        if from_client and message_type == b'd':
+            if seqno in self.seen:
+                self.counters['retransmissions'] += 1
+            self.seen.add(seqno)
+            self.sent_at[seqno] = now
+        elif not from_client and message_type == b'a' and seqno in self.sent_at:
+            self.ack_latencies.append(now - self.sent_at.pop(seqno))
+
+    def run(self):
+        while self.running:
+            timeout = max(self.queue[0][0] - time.monotonic(), 0) if self.queue else 0.05
+            for key, _ in self.selector.select(timeout=min(timeout, 0.05)):
+                client_addr = key.data
+                data, addr = key.fileobj.recvfrom(RECV_BUF_SIZE)
+                if client_addr is None:
+                    # Every client gets its own upstream socket, the server tells clients apart by address
+                    if (upstream := self.upstream.get(addr)) is None:
+                        upstream = self.upstream[addr] = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
+                        upstream.bind(('127.0.0.1', 0))
+                        self.selector.register(upstream, selectors.EVENT_READ, addr)
+                    self.track(data, True)
+                    self.schedule(upstream, data, self.server_addr)
+                else:
+                    self.track(data, False)
+                    self.schedule(self.socket, data, client_addr)
+
+            now = time.monotonic()
+            while self.queue and self.queue[0][0] <= now:
+                _, _, sock, data, addr = heapq.heappop(self.queue)
+                sock.sendto(data, addr)
+                self.counters['forwarded'] += 1
+
+    def stop(self):
+        self.running = False
+        self.join()
+        for upstream in self.upstream.values():
+            upstream.close()
+        self.socket.close()
+        self.selector.close()
+
+
+def free_port():
+    with socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def cpu_time(usage):
+    return usage.ru_utime + usage.ru_stime
+
+
+def run_transfer(workdir, file_size, mss, args):
+    client_dir, server_dir = os.path.join(workdir, 'client'), os.path.join(workdir, 'server')
+    os.makedirs(client_dir, exist_ok=True)
+    os.makedirs(server_dir, exist_ok=True)
+    file_path = os.path.join(client_dir, f'bench_{file_size}.bin')
+    if not os.path.exists(file_path):
+        with open(file_path, 'wb') as f:
+            f.write(os.urandom(file_size))
+    received_path = os.path.join(server_dir, os.path.basename(file_path))
+    if os.path.exists(received_path):
+        os.remove(received_path)
+
+    port = free_port()
+    server = subprocess.Popen([sys.executable, SERVER_PATH, str(port)], cwd=server_dir,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    time.sleep(0.3)
+    proxy = LossyProxy(('127.0.0.1', port), args.loss, args.duplicate, args.reorder,
+                       args.delay / 1000, args.jitter / 1000)
+    proxy.start()
+
+    t = time.monotonic()
+    client = subprocess.Popen([sys.executable, CLIENT_PATH, f'127.0.0.1:{proxy.addr[1]}', file_path,
+                               '--mss', str(mss), '--window', str(args.window)],
+                              cwd=client_dir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        _, status, client_usage = os.wait4(client.pid, 0)
+        client.returncode = os.waitstatus_to_exitcode(status)
+    except KeyboardInterrupt:
+        client.kill()
+        raise
+    finally:
+        elapsed = time.monotonic() - t
+        proxy.stop()
+        server.send_signal(signal.SIGINT)
+        _, _, server_usage = os.wait4(server.pid, 0)
+
+    with open(file_path, 'rb') as src, open(received_path, 'rb') as dst:
+        intact = client.returncode == 0 and src.read() == dst.read()
+
+    return {
+        'file_size': file_size,
+        'mss': mss,
+        'ok': intact,
+        'seconds': round(elapsed, 4),
+        'goodput_mbps': round(file_size * 8 / elapsed / 1e6, 2),
+        'client_cpu_s': round(cpu_time(client_usage), 4),
+        'server_cpu_s': round(cpu_time(server_usage), 4),
+        'cpu_s_per_mb': round((cpu_time(client_usage) + cpu_time(server_usage)) / (file_size / (1 << 20)), 4),
+        'ack_latency_p50_ms': round(percentile(proxy.ack_latencies, 50) * 1000, 3) if proxy.ack_latencies else None,
+        'ack_latency_p99_ms': round(percentile(proxy.ack_latencies, 99) * 1000, 3) if proxy.ack_latencies else None,
+        'ack_latency_max_ms': round(max(proxy.ack_latencies) * 1000, 3) if proxy.ack_latencies else None,
+        **proxy.counters,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks lab1 uploads over an emulated lossy link')
+    parser.add_argument('--sizes', type=str, default='64K,1M,16M', help='Comma-separated file sizes')
+    parser.add_argument('--mss', type=str, default='1400,8192,20471', help='Comma-separated chunk sizes')
+    parser.add_argument('--window', type=int, default=64)
+    parser.add_argument('--loss', type=float, default=0.0, help='Probability to drop a datagram')
+    parser.add_argument('--duplicate', type=float, default=0.0, help='Probability to duplicate a datagram')
+    parser.add_argument('--reorder', type=float, default=0.0, help='Probability to hold a datagram back')
+    parser.add_argument('--delay', type=float, default=0.0, help='One-way delay in milliseconds')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Extra random delay in milliseconds')
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--json', type=str, default=None, help='Writes the results to this file')
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    results = []
+    columns = ['file_size', 'mss', 'ok', 'seconds', 'goodput_mbps', 'client_cpu_s', 'server_cpu_s',
+               'cpu_s_per_mb', 'retransmissions', 'dropped', 'ack_latency_p50_ms', 'ack_latency_p99_ms']
+    print(' '.join(f'{c:>18}' for c in columns))
+
+    with tempfile.TemporaryDirectory() as workdir:
+        try:
+            for size, mss in itertools.product(map(parse_size, args.sizes.split(',')), map(int, args.mss.split(','))):
+                for _ in range(args.repeat):
+                    result = run_transfer(workdir, size, mss, args)
+                    results.append(result)
+                    print(' '.join(f'{str(result[c]):>18}' for c in columns))
+        except KeyboardInterrupt:
+            print('Benchmark: Exiting...')
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'settings': vars(args), 'results': results}, f, indent=2)
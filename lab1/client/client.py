@@ -1,41 +1,221 @@
 import argparse
+import hashlib
 import math
+import mmap
 import os
 import time
 import socket
+import struct
+import zlib
 
-MSS = 20476  # MSS = Server buffer size (20480) - data header size (4)
+HEADER = struct.Struct("!cII")  # Message type, sequence number and CRC32 of the payload
+MSS = 20480 - HEADER.size  # MSS = Server buffer size (20480) - data header size (9)
+WINDOW = 64  # Upper bound for the congestion window, 1 behaves like stop-and-wait
+ACK_BUF_SIZE = 20480
 
+INITIAL_RTO = 1  # Retransmission timeout before the first RTT sample
+MIN_RTO = 0.02
+MAX_RTO = 60
+MAX_RETRIES = 10  # Giving up after this many retransmissions of the same packet
 
-def await_ack(packet):
-    s.settimeout(1)
+
+class RetransmissionTimer:
+    # RTO estimation as in Jacobson/Karels (RFC 6298)
+    ALPHA = 1 / 8
+    BETA = 1 / 4
+
+    def __init__(self):
+        self.srtt = self.rttvar = None
+        self.rto = INITIAL_RTO
+
+    def sample(self, rtt):
+        if self.srtt is None:
+            self.srtt, self.rttvar = rtt, rtt / 2
+        else:
+            self.rttvar = (1 - self.BETA) * self.rttvar + self.BETA * abs(self.srtt - rtt)
+            self.srtt = (1 - self.ALPHA) * self.srtt + self.ALPHA * rtt
+        self.rto = min(max(self.srtt + 4 * self.rttvar, MIN_RTO), MAX_RTO)
+
+    def backoff(self):
+        # Exponential backoff until the next valid sample
+        self.rto = min(self.rto * 2, MAX_RTO)
+
+
+class StreamingDigest:
+    # BLAKE2 digest of the file, computed in order while the chunks are being sent
+    def __init__(self, data):
+        self.data = data
+        self.hasher = hashlib.blake2b()
+        self.hashed = 0
+
+    def update_to(self, end):
+        if end > self.hashed:
+            self.hasher.update(self.data[self.hashed:end])
+            self.hashed = end
+
+    def digest(self):
+        self.update_to(len(self.data))
+        return self.hasher.digest()
+
+
+class InFlight:
+    def __init__(self, packet):
+        # Header and payload are kept as separate buffers and sent with scatter/gather
+        self.packet = packet
+        self.sent_at = time.monotonic()
+        self.deadline = self.sent_at + timer.rto
+        self.retries = 0
+
+    def retransmit(self, now):
+        self.retries += 1
+        if self.retries > MAX_RETRIES:
+            print(f"Client: No ACK after {MAX_RETRIES} retransmissions. Giving up...")
+            exit(1)
+        send(self.packet)
+        # The timer is backed off by the caller once per loss
+        self.deadline = now + timer.rto
+
+
+def send(packet):
+    # A zero receive timeout leaves the socket non-blocking, a full send buffer would then raise BlockingIOError.
+    # Sends wait for room in the buffer instead
+    s.settimeout(None)
+    s.sendmsg(packet, [], 0, (server_ip, server_port))
+
+
+def make_packet(message_type, seqno, payload):
+    return HEADER.pack(message_type, seqno, zlib.crc32(payload)), payload
+
+
+def recv_reply():
+    # Returns message type, sequence number and payload of a reply, or None if it is corrupted
+    size, addr = s.recvfrom_into(ack_buf)
+    message_type, seqno, crc = HEADER.unpack_from(ack_buf)
+    payload = ack_view[HEADER.size:size]
+    if zlib.crc32(payload) != crc:
+        return None
+    print(f"Server: {message_type.decode()}|{seqno}")
+    return message_type, seqno, payload
+
+
+def await_ack(packet, expected_ack_seqno):
+    # Returns the payload of the ACK, or None if the server rejected the packet
+    pending = InFlight(packet)
     while True:
         try:
-            data, addr = s.recvfrom(1024)
-            print(f"Server: {data.decode()}")
-            received_ack_seqno = int(data[2:3].decode())
-            expected_ack_seqno = (int(packet[2:3].decode()) + 1) % 2
+            s.settimeout(max(pending.deadline - time.monotonic(), 0))
+            if (reply := recv_reply()) is None:
+                continue
+            message_type, received_ack_seqno, payload = reply
             if received_ack_seqno != expected_ack_seqno:
                 continue
-            return True
+            # Karn's algorithm: ACKs of retransmitted packets are ambiguous
+            if pending.retries == 0:
+                timer.sample(time.monotonic() - pending.sent_at)
+            return bytes(payload) if message_type == b"a" else None
         except KeyboardInterrupt:
             print("Client: Exiting...")
             exit()
-        except socket.timeout:  # Expected ACK was not received within one second
+        # A zero timeout makes the socket non-blocking, so an overdue deadline raises BlockingIOError
+        except (socket.timeout, BlockingIOError):  # Expected ACK was not received within the retransmission timeout
             print(f"Client: Retransmitting...")
-            s.sendto(packet, (server_ip, server_port))
+            timer.backoff()
+            pending.retransmit(time.monotonic())
+
+
+def missing_chunks(held, file_size, mss):
+    # Returns sequence numbers of the chunks not fully covered by the byte ranges the server holds
+    ranges = sorted(tuple(map(int, r.split("-"))) for r in held.decode().split(",") if r)
+    missing = []
+    i = 0
+    for seqno in range(1, math.ceil(file_size / mss) + 1):
+        start, end = (seqno - 1) * mss, min(seqno * mss, file_size)
+        while i < len(ranges) and ranges[i][1] <= start:
+            i += 1
+        if i == len(ranges) or not ranges[i][0] <= start < end <= ranges[i][1]:
+            missing.append(seqno)
+    return missing
+
+
+def send_window(data, seqnos, window, mss, digest):
+    # Selective repeat: up to `cwnd` chunks are in flight, each one is
+    # acknowledged and retransmitted on its own timer. The congestion window
+    # grows by slow start / additive increase and is halved on loss (AIMD)
+    in_flight = {}  # seqno -> InFlight
+    pending = iter(seqnos)
+    next_seqno = next(pending, None)
+    acked = 0
+    cwnd, ssthresh = 1.0, float(window)
+    # Losses of chunks sent before the last decrease belong to the same congestion event
+    recovery_point = 0.0
+    retransmissions = 0
+
+    while acked < len(seqnos):
+        # Filling the window with new chunks
+        while next_seqno is not None and len(in_flight) < min(int(cwnd), window):
+            print(f"Client: d|{next_seqno}|chunk{next_seqno}")
+            offset = (next_seqno - 1) * mss
+            packet = make_packet(b"d", next_seqno, data[offset:offset + mss])
+            digest.update_to(offset + mss)
+            send(packet)
+            in_flight[next_seqno] = InFlight(packet)
+            next_seqno = next(pending, None)
+
+        # Waiting for an ACK no longer than until the earliest retransmission
+        s.settimeout(max(min(chunk.deadline for chunk in in_flight.values()) - time.monotonic(), 0))
+        try:
+            if (reply := recv_reply()) is not None and reply[1] in in_flight:
+                message_type, seqno, _ = reply
+                if message_type == b"n":
+                    # The chunk arrived corrupted, it is sent again right away
+                    print(f"Client: Retransmitting corrupted chunk {seqno}...")
+                    in_flight[seqno].retransmit(time.monotonic())
+                    retransmissions += 1
+                else:
+                    chunk = in_flight.pop(seqno)
+                    acked += 1
+                    if chunk.retries == 0:
+                        timer.sample(time.monotonic() - chunk.sent_at)
+                    cwnd = min(cwnd + 1 if cwnd < ssthresh else cwnd + 1 / cwnd, window)
+        except KeyboardInterrupt:
+            print("Client: Exiting...")
+            exit()
+        except (socket.timeout, BlockingIOError):
+            pass
+
+        # Retransmitting every chunk whose timer has expired
+        now = time.monotonic()
+        expired = [(seqno, chunk) for seqno, chunk in in_flight.items() if chunk.deadline <= now]
+        if expired and any(chunk.sent_at >= recovery_point for _, chunk in expired):
+            ssthresh = max(cwnd / 2, 1)
+            cwnd = ssthresh
+            recovery_point = now
+            timer.backoff()
+        for seqno, chunk in expired:
+            print(f"Client: Retransmitting chunk {seqno}...")
+            chunk.retransmit(now)
+            retransmissions += 1
+
+    print(f"Client: Uploaded {len(seqnos)} chunks with {retransmissions} retransmissions, "
+          f"srtt: {timer.srtt or 0:.4f}s, rto: {timer.rto:.3f}s, cwnd: {cwnd:.1f}")
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("server_addr", type=str)
     parser.add_argument("file_path", type=str)
+    parser.add_argument("--window", type=int, default=WINDOW)
+    parser.add_argument("--mss", type=int, default=MSS)
     args = parser.parse_args()
+    if not 1 <= args.mss <= MSS:
+        parser.error(f"--mss must be between 1 and {MSS}, the server can not receive larger chunks")
 
     server_ip, server_port = args.server_addr.split(":")
     server_port = int(server_port)
     file_name = args.file_path.split(os.path.sep)[-1]
-    file_size = os.path.getsize(args.file_path)
+    timer = RetransmissionTimer()
+    ack_buf = bytearray(ACK_BUF_SIZE)
+    ack_view = memoryview(ack_buf)
 
     with socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM) as s:
 
@@ -44,20 +224,35 @@ if __name__ == "__main__":
             print(f"Client: no such file: {args.file_path}")
             exit()
 
+        file_size = os.path.getsize(args.file_path)
+
         # Send start packet to server
-        packet = f"s|0|{file_name}|{file_size}".encode()
-        print(f"Client: {packet.decode()}")
-        s.sendto(packet, (server_ip, server_port))
+        start = f"{file_name}|{file_size}|{args.mss}"
+        print(f"Client: s|0|{start}")
+        packet = make_packet(b"s", 0, start.encode())
+        send(packet)
 
-        # Wait for ACK for the given packet
-        await_ack(packet)
+        # Wait for ACK for the given packet, it lists the byte ranges the server already holds
+        held = await_ack(packet, 0)
+        if held is None:
+            print("Client: Server rejected the upload")
+            exit(1)
+        seqnos = missing_chunks(held, file_size, args.mss)
+        print(f"Client: {len(seqnos)} of {math.ceil(file_size / args.mss)} chunks to upload")
 
-        # Upload file to server
-        seqno = 1
+        # Upload the missing part of the file to server, chunks are sliced from the mapping without copying
         with open(args.file_path, "rb") as f:
-            for i in range(math.ceil(file_size / MSS)):
-                print(f"Client: d|{seqno}|chunk{i + 1}")
-                packet = bytes(f"d|{seqno}|", "utf-8") + f.read(MSS)
-                s.sendto(packet, (server_ip, server_port))
-                await_ack(packet)
-                seqno = (seqno + 1) % 2
+            data = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if file_size else b"")
+        digest = StreamingDigest(data)
+        if seqnos:
+            send_window(data, seqnos, max(args.window, 1), args.mss, digest)
+
+        # Confirm the upload with the digest of the entire file
+        final_seqno = math.ceil(file_size / args.mss) + 1
+        packet = make_packet(b"f", final_seqno, digest.digest())
+        print(f"Client: f|{final_seqno}|{digest.digest().hex()}")
+        send(packet)
+        if await_ack(packet, final_seqno) is None:
+            print("Client: Server rejected the file digest, the upload is corrupted")
+            exit(1)
+        print("Client: Server confirmed the file digest")
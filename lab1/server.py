@@ -1,73 +1,324 @@
 import socket
 import argparse
+import bisect
+import hashlib
+import json
 import os
-import math
+import selectors
+import struct
+import time
+import zlib
 
 RECV_BUF_SIZE = 20480
+HEADER = struct.Struct('!cII')  # Message type, sequence number and CRC32 of the payload
+MAX_MSS = RECV_BUF_SIZE - HEADER.size  # Larger chunks would be truncated by the receive buffer
+HASH_BLOCK_SIZE = 1 << 20  # Block size for hashing data that is read back from disk
+INDEX_SUFFIX = '.index'
+INDEX_FLUSH_CHUNKS = 64  # Persist the partial-file index every N written chunks
+SESSION_TIMEOUT = 30  # Seconds of silence after which a client session is evicted
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser()
-    parser.add_argument('port', type=str)
-    args = parser.parse_args()
 
-    port = int(args.port)
+def add_range(ranges, start, end):
+    # Inserting [start, end) into the sorted list of disjoint byte ranges, merging neighbours
+    i = bisect.bisect_left(ranges, [start, start])
+    if i > 0 and ranges[i - 1][1] >= start:
+        i -= 1
+        start = ranges[i][0]
+    j = i
+    while j < len(ranges) and ranges[j][0] <= end:
+        end = max(end, ranges[j][1])
+        j += 1
+    ranges[i:j] = [[start, end]]
+
+
+def format_ranges(ranges, limit):
+    # Reporting only as many ranges as fit into a datagram, the client resends the rest
+    reported = []
+    length = 0
+    for start, end in ranges:
+        item = f'{start}-{end}'
+        length += len(item) + 1
+        if length > limit:
+            break
+        reported.append(item)
+    return ','.join(reported)
+
+
+def load_index(file_name, file_size):
+    # Returns the byte ranges already held for the file, or None if there is no usable index
+    try:
+        with open(file_name + INDEX_SUFFIX, 'r') as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if index.get('size') != file_size or not os.path.exists(file_name):
+        return None
+    return index['ranges']
+
+
+def save_index(file_name, fd, file_size, ranges):
+    # The data has to reach the disk before the index claims it
+    os.fsync(fd)
+    tmp_name = file_name + INDEX_SUFFIX + '.tmp'
+    with open(tmp_name, 'w') as f:
+        json.dump({'size': file_size, 'ranges': ranges}, f)
+    os.replace(tmp_name, file_name + INDEX_SUFFIX)
+
+
+class Session:
+    # Upload state of a single client, the server keeps one per address
+    def __init__(self, addr):
+        self.addr = addr
+        self.fd = self.file_name = self.file_size = self.mss = None
+        # Byte ranges of the file that are already on disk, and chunks received in this session
+        self.ranges = []
+        self.received = set()
+        self.unsaved_chunks = 0
+        self.last_seen = time.monotonic()
+        # Whole-file digest over the contiguous prefix of the file, updated as it grows
+        self.hasher = None
+        self.hashed = 0
+        self.verified = False
+
+    def start(self, file_name, file_size, mss):
+        self.file_name, self.file_size, self.mss = file_name, file_size, mss
+        self.received.clear()
+        self.unsaved_chunks = 0
+        self.hasher = hashlib.blake2b()
+        self.hashed = 0
+        self.verified = False
+
+        print(f'{self.addr}: Received the starting message')
+        print(f'Preparing to receive {file_name} with size of {file_size} bytes in chunks of {mss} bytes')
+
+        if (held := load_index(file_name, file_size)) is not None:
+            self.ranges = held
+            print(f'Resuming {file_name}: {sum(end - start for start, end in held)} bytes already held\n')
+        else:
+            self.ranges = []
+            # Checking if the file already exists
+            if os.path.exists(file_name):
+                print(f'File {file_name} already exists. Data will be overwritten\n')
+
+        # Chunks may arrive out of order, so they are written at their offsets
+        self.fd = os.open(file_name, os.O_RDWR | os.O_CREAT)
+        try:
+            if not self.ranges:
+                os.ftruncate(self.fd, file_size)
+                save_index(file_name, self.fd, file_size, self.ranges)
+        except OSError:
+            os.close(self.fd)
+            self.fd = None
+            raise
+
+    def write(self, sequence_number, payload):
+        # Returns False if the chunk does not belong to the file
+        offset = (sequence_number - 1) * self.mss
+        if sequence_number < 1 or offset + len(payload) > self.file_size:
+            return False
+
+        os.pwrite(self.fd, payload, offset)
+        add_range(self.ranges, offset, offset + len(payload))
+        self.received.add(sequence_number)
+        if offset == self.hashed:
+            self.hasher.update(payload)
+            self.hashed += len(payload)
+        self.update_digest()
+        self.unsaved_chunks += 1
+        print(f'{self.addr}: Received the chunk {sequence_number} with size {len(payload)}. '
+              f'Bytes left: {self.file_size - sum(end - start for start, end in self.ranges)}')
+
+        if self.unsaved_chunks >= INDEX_FLUSH_CHUNKS:
+            save_index(self.file_name, self.fd, self.file_size, self.ranges)
+            self.unsaved_chunks = 0
+        return True
+
+    def update_digest(self):
+        # Hashing the chunks that arrived out of order (or in a previous session) once the gap before them is filled
+        end = self.ranges[0][1] if self.ranges and self.ranges[0][0] == 0 else 0
+        while self.hashed < end:
+            block = os.pread(self.fd, min(HASH_BLOCK_SIZE, end - self.hashed), self.hashed)
+            self.hasher.update(block)
+            self.hashed += len(block)
+
+    def is_complete(self):
+        return self.file_size == 0 or self.ranges == [[0, self.file_size]]
+
+    def verify(self, digest):
+        # Compares the digest sent by the client with the one of the received file
+        self.update_digest()
+        self.verified = self.hasher.digest() == digest
+        if self.verified:
+            print(f'{self.addr}: Successfully received entire file {self.file_name}\n')
+        else:
+            print(f'{self.addr}: Digest of {self.file_name} does not match. The file will be uploaded again\n')
+            # Dropping the index, so the next attempt overwrites the whole file
+            os.remove(self.file_name + INDEX_SUFFIX)
+            os.close(self.fd)
+            self.fd = None
+        return self.verified
+
+    def close(self):
+        if self.fd is None:
+            return
+        if self.verified:
+            os.remove(self.file_name + INDEX_SUFFIX)
+        else:
+            # An unfinished or unconfirmed upload stays resumable
+            save_index(self.file_name, self.fd, self.file_size, self.ranges)
+        os.close(self.fd)
+        self.fd = None
+
+
+class Server:
+    def __init__(self, port):
+        self.socket = None
+        self.port = port
+        self.sessions = {}  # addr -> Session
+        self.selector = selectors.DefaultSelector()
+
+    def send(self, data, addr):
+        try:
+            self.socket.sendto(data, addr)
+        except BlockingIOError:
+            # The send buffer is full, the client will retransmit
+            pass
 
-    chunks = received_chunk = file = message_type = ack = None
+    def reply(self, message_type, sequence_number, addr, payload=b''):
+        # Every packet is acknowledged ('a') or rejected ('n') individually (selective repeat)
+        self.send(HEADER.pack(message_type, sequence_number, zlib.crc32(payload)) + payload, addr)
 
-    with socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM) as s:
-        local_addr = ('0.0.0.0', port)
-        s.bind(local_addr)
+    def handle_packet(self, packet, addr):
+        # The payload is a view into the receive buffer, it is only valid until the next datagram
+        message_type, sequence_number, crc = HEADER.unpack_from(packet)
+        payload = packet[HEADER.size:]
+
+        if (session := self.sessions.get(addr)) is None:
+            session = self.sessions[addr] = Session(addr)
+        session.last_seen = time.monotonic()
+
+        if message_type == b's':
+            if zlib.crc32(payload) != crc:
+                return
+
+            start_fields = bytes(payload).split(b'|')
+            file_name, file_size, mss = start_fields[0].decode(), int(start_fields[1]), int(start_fields[2])
+            if file_size < 0 or not 1 <= mss <= MAX_MSS:
+                print(f'{addr}: Invalid file size {file_size} or chunk size {mss}. Rejecting...')
+                self.reply(b'n', sequence_number, addr)
+                return
+
+            # Handling retransmitted starting message
+            if file_name != session.file_name or session.fd is None:
+                if any(other.file_name == file_name and other.fd is not None
+                       for other in self.sessions.values() if other is not session):
+                    # Not acking, the client retries until the other upload is done or evicted
+                    print(f'{addr}: {file_name} is being uploaded by another client. Deferring...')
+                    return
+
+                session.close()
+                try:
+                    session.start(file_name, file_size, mss)
+                except OSError as err:
+                    print(f'{addr}: Can not receive {file_name}: {err}. Rejecting...')
+                    self.reply(b'n', sequence_number, addr)
+                    return
+
+            # The start ACK lists the byte ranges that are already held
+            self.reply(b'a', sequence_number, addr, format_ranges(session.ranges, RECV_BUF_SIZE - HEADER.size).encode())
+        elif message_type == b'd':
+            # Handling retransmitted chunk by its sequence number (not writing same chunk to file)
+            if sequence_number in session.received:
+                self.reply(b'a', sequence_number, addr)
+                return
+
+            if session.fd is None:
+                return
+
+            if zlib.crc32(payload) != crc:
+                # Asking for this chunk again instead of waiting for the client to time out
+                print(f'{addr}: Chunk {sequence_number} is corrupted. Requesting it again...')
+                self.reply(b'n', sequence_number, addr)
+                return
+
+            if not session.write(sequence_number, payload):
+                print(f'{addr}: Received chunk {sequence_number} out of range. Ignoring...')
+                return
+
+            self.reply(b'a', sequence_number, addr)
+        elif message_type == b'f':
+            # Final message with the digest of the entire file
+            if session.verified:
+                self.reply(b'a', sequence_number, addr)
+                return
+
+            if session.fd is None or zlib.crc32(payload) != crc or not session.is_complete():
+                return
+
+            self.reply(b'a' if session.verify(bytes(payload)) else b'n', sequence_number, addr)
+            # Closing the file after receiving all chunks and the matching digest
+            session.close()
+
+    def evict_idle_sessions(self):
+        now = time.monotonic()
+        for addr, session in list(self.sessions.items()):
+            if now - session.last_seen > SESSION_TIMEOUT:
+                print(f'{addr}: Session is idle for {SESSION_TIMEOUT} seconds. Evicting...')
+                session.close()
+                del self.sessions[addr]
+
+    def start(self):
+        self.socket = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
+        local_addr = ('0.0.0.0', self.port)
+        self.socket.bind(local_addr)
+        self.socket.setblocking(False)
+        self.selector.register(self.socket, selectors.EVENT_READ)
         print(f'{local_addr}: Listening...')
+        # Datagrams are received into one preallocated buffer instead of a new bytes object each
+        buf = bytearray(RECV_BUF_SIZE)
+        view = memoryview(buf)
+        next_sweep = time.monotonic() + SESSION_TIMEOUT / 2
 
         while True:
-            try:
-                data, addr = s.recvfrom(RECV_BUF_SIZE)
-            except KeyboardInterrupt:
-                print('Server: Exiting...')
-                exit()
-            except ConnectionResetError:
-                print('Client sends delayed chunk after closing connection. Denying...')
-                continue
-
-            # Splitting received data
-            fields = data.split(b'|')
-            # Handling retransmitted starting message
-            if message_type is not None and ack is not None and fields[0].decode() == message_type == 's':
-                s.sendto(f'{ack}'.encode(), addr)
-                continue
-
-            message_type, sequence_number = fields[0].decode(), int(fields[1].decode())
-            ack = f'a|{str((sequence_number + 1) % 2)}'
-
-            if message_type == 's':
-                file_name, file_size = fields[2].decode(), int(fields[3].decode())
-
-                print(f'{addr}: Received the starting message')
-                print(f'Preparing to receive {file_name} with size of {file_size} bytes')
-                # Calculating the amount of chunks that we will receive from client
-                chunks = math.ceil(file_size / RECV_BUF_SIZE)
-
-                s.sendto(ack.encode(), addr)
-
-                # Checking if the file already exists
-                if os.path.exists(file_name):
-                    print(f'File {file_name} already exists. Data will be overwritten\n')
-                    os.remove(file_name)
-
-                file = open(file_name, 'ab')
-            elif message_type == 'd':
-                # Handling retransmitted chunk (not writing same chunk to file)
-                if received_chunk is not None and received_chunk == b'|'.join(fields[2:]):
-                    s.sendto(ack.encode(), addr)
-                    continue
-                received_chunk = b'|'.join(fields[2:])
-                chunks -= 1
-                print(f'{addr}: Received the chunk with size {len(received_chunk)}. Chunks left: {chunks}')
-                s.sendto(ack.encode(), addr)
-
-                file.write(received_chunk)
-
-            # Closing the file after receiving all chunks
-            if chunks == 0 and file is not None:
-                print('Successfully received entire file\n')
-                file.close()
+            for _ in self.selector.select(timeout=SESSION_TIMEOUT / 2):
+                # Draining every datagram that is already queued
+                while True:
+                    try:
+                        size, addr = self.socket.recvfrom_into(buf)
+                    except BlockingIOError:
+                        break
+                    except ConnectionResetError:
+                        print('Client sends delayed chunk after closing connection. Denying...')
+                        continue
+
+                    try:
+                        self.handle_packet(view[:size], addr)
+                    except (ValueError, IndexError, struct.error):
+                        print(f'{addr}: Received malformed packet. Ignoring...')
+                    except OSError as err:
+                        # A failing disk operation only affects the session it belongs to
+                        print(f'{addr}: Failed to handle a packet: {err}')
+
+            if time.monotonic() >= next_sweep:
+                self.evict_idle_sessions()
+                next_sweep = time.monotonic() + SESSION_TIMEOUT / 2
+
+    def stop(self):
+        for session in self.sessions.values():
+            session.close()
+        self.selector.close()
+        self.socket.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('port', type=str)
+    args = parser.parse_args()
+
+    server = Server(int(args.port))
+    try:
+        server.start()
+    except KeyboardInterrupt:
+        print('Server: Exiting...')
+    finally:
+        server.stop()
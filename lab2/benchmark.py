@@ -0,0 +1,68 @@
+import argparse
+import itertools
+import json
+import os
+import re
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+LAB_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVER_PATH = os.path.join(LAB_DIR, 'server.py')
+CLIENT_PATH = os.path.join(LAB_DIR, 'client.py')
+PORT = 1234
+MODES = ['threaded', 'asyncio']
+
+
+def wait_for_server(timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', PORT), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise TimeoutError(f'Server did not start listening on port {PORT}')
+
+
+def run(server_mode, client_mode, workdir, client_args, processes=1):
+    # Returns the download time reported by the client
+    server = subprocess.Popen([sys.executable, SERVER_PATH, '--mode', server_mode, '--processes', str(processes)],
+                              cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for_server()
+        output = subprocess.run([sys.executable, CLIENT_PATH, '--mode', client_mode, *client_args],
+                                cwd=workdir, capture_output=True, text=True, check=True).stdout
+    finally:
+        server.send_signal(signal.SIGINT)
+        try:
+            server.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            server.kill()
+            server.wait()
+
+    return float(re.search(r'Frames download time: ([\d.]+)', output).group(1))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compares download times of the threaded and asyncio lab2 modes')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--processes', type=int, default=1, help='Server worker processes')
+    parser.add_argument('--json', type=str, default=None, help='Writes the results to this file')
+    args = parser.parse_args()
+
+    results = []
+    print(f'{"server":>10} {"client":>10} {"best, s":>10} {"median, s":>10}')
+    with tempfile.TemporaryDirectory() as workdir:
+        for server_mode, client_mode in itertools.product(MODES, MODES):
+            times = [run(server_mode, client_mode, workdir, ['--no-gif'], args.processes) for _ in range(args.repeat)]
+            results.append({'server': server_mode, 'client': client_mode, 'times': times})
+            print(f'{server_mode:>10} {client_mode:>10} {min(times):>10.3f} {statistics.median(times):>10.3f}')
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -1,108 +1,281 @@
-import os
+import argparse
+import asyncio
+import io
 import socket
+import struct
 import time
-import multiprocessing
 import threading
-import shutil
+from collections import deque
 
+import numpy as np
 from PIL import Image
 
+from gif import GifStreamWriter, PaletteMapper, build_palette
+from metrics import Metrics, write_report
+
 SERVER_URL = '127.0.0.1:1234'
 FILE_NAME = 'result.gif'
-CLIENT_BUFFER = 1024
+CLIENT_BUFFER = 65536  # Upper bound of bytes read by one recv call
+FRAME_BUFFER = 4096  # Initial size of the per-connection frame buffer, it grows to the largest frame
 FRAME_COUNT = 5000
-CHUNK_SIZE = 20
+CONNECTIONS = 8  # Persistent connections, each one streams a task of frames at a time
+TASK_SIZE = 100  # Frames downloaded by one task over one connection
+REORDER_WINDOW = CONNECTIONS * TASK_SIZE  # Frames that may be downloaded ahead of the next one written to the GIF
+QUANTIZE_BATCH = TASK_SIZE  # Frames quantized at once, the first batch also defines the global palette
+MAX_RETRIES = 5
+BACKOFF = 0.05  # Delay before the first retry in seconds, doubled on every next one
+
+REQUEST = struct.Struct('!I')  # Number of frames requested over the connection
+FRAME_HEADER = struct.Struct('!I')  # Length of the PNG that follows
+
+metrics = Metrics()
+
+
+class FrameAssembler:
+    # Decodes frames as they arrive and appends them to the GIF in order. Frames that arrive ahead
+    # of the next one wait in the reorder buffer, a task may only start downloading when all of its
+    # frames fit into the window, so the buffer never holds more than `window` frames.
+    # Frames in order are quantized in batches with one palette shared by the whole GIF
+    def __init__(self, writer, window=REORDER_WINDOW, batch_size=QUANTIZE_BATCH):
+        self.writer = writer
+        self.window = window
+        self.batch_size = batch_size
+        self.next_id = 0
+        self.pending = {}
+        self.batch = []
+        self.mapper = None
+        self.aborted = False
+        self.encode_time = 0
+        self.quantize_time = 0
+        self.condition = threading.Condition()
+        self.progress = None  # asyncio.Event, set every time the GIF grows
+
+    def has_room(self, last_id):
+        return last_id < self.next_id + self.window or self.aborted
+
+    def reserve(self, last_id):
+        with self.condition:
+            self.condition.wait_for(lambda: self.has_room(last_id))
+        if self.aborted:
+            raise ConnectionError('Download was aborted')
+
+    async def reserve_async(self, last_id):
+        if self.progress is None:
+            self.progress = asyncio.Event()
+        while not self.has_room(last_id):
+            self.progress.clear()
+            await self.progress.wait()
+
+    def add(self, frame_id, data):
+        frame = None
+        if self.writer is not None:
+            with metrics.timer('decode_s'):
+                frame = np.asarray(Image.open(io.BytesIO(data)).convert('RGB'))
+        with self.condition:
+            self.pending[frame_id] = frame
+            while self.next_id in self.pending:
+                frame = self.pending.pop(self.next_id)
+                if self.writer is not None:
+                    self.batch.append(frame)
+                self.next_id += 1
+            if len(self.batch) >= self.batch_size:
+                self.flush()
+            self.condition.notify_all()
+        if self.progress is not None:
+            self.progress.set()
+
+    def flush(self):
+        if not self.batch:
+            return
+        t = time.time()
+        frames = np.stack(self.batch)
+        self.batch.clear()
+        if self.mapper is None:
+            # Transparent pixels of the optimized frames need an index of their own
+            palette, colors = build_palette(frames, 255 if self.writer.optimize else 256)
+            self.mapper = PaletteMapper(palette, colors)
+            self.writer.write_header(frames.shape[2], frames.shape[1], palette)
+        indices = self.mapper.map(frames)
+        self.quantize_time += time.time() - t
+        metrics.record('quantize_batch_s', time.time() - t)
 
-gathered_frames = set()
+        t = time.time()
+        for frame in indices:
+            with metrics.timer('encode_s'):
+                self.writer.write_frame(frame)
+        self.encode_time += time.time() - t
 
+    def finish(self):
+        with self.condition:
+            self.flush()
+        if self.mapper is not None:
+            self.mapper.close()
 
-def download_frames(frame_id):
-    # Downloading frames in chunks per thread
-    for cur_frame in range(frame_id * CHUNK_SIZE, (frame_id + 1) * CHUNK_SIZE):
-        download_frame(cur_frame)
+    def abort(self):
+        with self.condition:
+            self.aborted = True
+            self.condition.notify_all()
 
 
-def download_frame(frame_id):
-    global gathered_frames
+def recv_exact(s, size, buffer, buffer_size=CLIENT_BUFFER):
+    # Reads exactly `size` bytes into the reusable buffer and returns a view of them,
+    # the view is only valid until the next call with the same buffer
+    if len(buffer) < size:
+        buffer.extend(bytes(size - len(buffer)))
+    view = memoryview(buffer)[:size]
+    received = 0
+    while received < size:
+        n = s.recv_into(view[received:], min(buffer_size, size - received))
+        if not n:
+            raise ConnectionError('Connection closed by server')
+        received += n
+    return view
 
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        ip, port = SERVER_URL.split(':')
 
+def download_frames(frame_ids, assembler, buffer_size=CLIENT_BUFFER):
+    # Downloading the given frames over one connection: a single request, then a stream of frames.
+    # A dropped connection is retried with exponential backoff from the first frame not yet received
+    ip, port = SERVER_URL.split(':')
+    remaining = deque(frame_ids)
+    header, buffer = bytearray(FRAME_HEADER.size), bytearray(FRAME_BUFFER)
+
+    for attempt in range(MAX_RETRIES + 1):
         try:
-            s.connect((ip, int(port)))
+            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+                with metrics.timer('connect_s'):
+                    s.connect((ip, int(port)))
+                s.sendall(REQUEST.pack(len(remaining)))
+
+                with metrics.timer('task_s'):
+                    while remaining:
+                        length, = FRAME_HEADER.unpack(recv_exact(s, FRAME_HEADER.size, header, buffer_size))
+                        # The frame is decoded before the buffer is reused for the next one
+                        assembler.add(remaining[0], recv_exact(s, length, buffer, buffer_size))
+                        remaining.popleft()
+                        metrics.count('bytes', FRAME_HEADER.size + length)
+                return
         except ConnectionRefusedError:
-            # Sometimes connection from server is refused and frames are missed
-            return
+            metrics.count('refused')
+        except OSError:
+            metrics.count('connection_errors')
 
-        image = b''
-        while True:
-            packet = s.recv(CLIENT_BUFFER)
-            if not packet:
-                break
-            image += packet
+        metrics.count('retries')
+        time.sleep(BACKOFF * 2 ** attempt)
 
-        with open(f'frames/{frame_id}.png', 'wb') as f:
-            f.write(image)
+    raise ConnectionError(f'Failed to download {len(remaining)} frames after {MAX_RETRIES} retries')
 
-        gathered_frames.add(frame_id)
 
+async def download_frames_async(frame_ids, semaphore, assembler):
+    # Same as download_frames, but on the event loop
+    ip, port = SERVER_URL.split(':')
+    remaining = deque(frame_ids)
+    await assembler.reserve_async(frame_ids[-1])
 
-def process_frame(frame_id):
-    return Image.open(f"frames/{frame_id}.png").convert("RGBA")
+    for attempt in range(MAX_RETRIES + 1):
+        async with semaphore:
+            writer = None
+            try:
+                with metrics.timer('connect_s'):
+                    reader, writer = await asyncio.open_connection(ip, int(port))
+                writer.write(REQUEST.pack(len(remaining)))
+                await writer.drain()
 
+                with metrics.timer('task_s'):
+                    while remaining:
+                        length, = FRAME_HEADER.unpack(await reader.readexactly(FRAME_HEADER.size))
+                        assembler.add(remaining[0], await reader.readexactly(length))
+                        remaining.popleft()
+                        metrics.count('bytes', FRAME_HEADER.size + length)
+                return
+            except ConnectionRefusedError:
+                metrics.count('refused')
+            except (OSError, asyncio.IncompleteReadError):
+                metrics.count('connection_errors')
+            finally:
+                if writer is not None:
+                    writer.close()
 
-def create_gif():
-    usable_cores = multiprocessing.cpu_count() - 1
-    t = time.time()
+        metrics.count('retries')
+        await asyncio.sleep(BACKOFF * 2 ** attempt)
 
-    # Creating pool of processes to concurrently open multiple images
-    with multiprocessing.Pool(usable_cores) as pool:
-        frames = list(pool.map(process_frame, range(FRAME_COUNT)))
+    raise ConnectionError(f'Failed to download {len(remaining)} frames after {MAX_RETRIES} retries')
 
-    frames[0].save(FILE_NAME, format="GIF",
-                   append_images=frames[1:], save_all=True, duration=500, loop=0)
 
-    return time.time() - t
+def split_tasks(frame_ids):
+    frame_ids = sorted(frame_ids)
+    return [frame_ids[i:i + TASK_SIZE] for i in range(0, len(frame_ids), TASK_SIZE)]
 
 
-if __name__ == '__main__':
-    if os.path.exists('frames'):
-        shutil.rmtree('frames')
+async def download_async(frame_ids, assembler):
+    # Many small tasks, at most CONNECTIONS of them hold a connection at the same time
+    semaphore = asyncio.Semaphore(CONNECTIONS)
+    await asyncio.gather(*(download_frames_async(task, semaphore, assembler) for task in split_tasks(frame_ids)))
 
-    if not os.path.exists('frames'):
-        os.mkdir('frames')
 
-    all_frames = set(range(FRAME_COUNT))
-    threads = []
+def download_in_threads(frame_ids, assembler, buffer_size=CLIENT_BUFFER):
+    # One thread per persistent connection, every thread takes the next task in order
+    tasks = iter(split_tasks(frame_ids))
+    lock = threading.Lock()
+    errors = []
 
-    t0 = time.time()
-    # Creating multiple threads to process frames in chunks concurrently
-    for frame in range(FRAME_COUNT // CHUNK_SIZE):
-        thread = threading.Thread(target=download_frames, args=(frame,))
-        threads.append(thread)
-        thread.start()
+    def worker():
+        while True:
+            with lock:
+                task = next(tasks, None)
+            if task is None:
+                return
+            try:
+                assembler.reserve(task[-1])
+                download_frames(task, assembler, buffer_size)
+            except ConnectionError as err:
+                errors.append(err)
+                assembler.abort()
+                return
 
+    threads = [threading.Thread(target=worker) for _ in range(CONNECTIONS)]
+    [thread.start() for thread in threads]
     [thread.join() for thread in threads]
-    threads.clear()
 
-    # Handling frames that are mysteriously lost due to connection refusal from server
-    # I have no clue why this is happening (server queue is of FRAME_COUNT size)
-    if missing_frames := all_frames.difference(gathered_frames):
-        missing_frames_iters = 0
+    if errors:
+        raise errors[0]
+
 
-        print(f'Time without missed frames: {time.time() - t0}')
-        gathered_frames.clear()
-        while missing_frames := missing_frames.difference(gathered_frames):
-            print('Lost frames:', len(missing_frames))
-            missing_frames_iters += 1
-            for frame in missing_frames:
-                thread = threading.Thread(target=download_frame, args=(frame,))
-                threads.append(thread)
-                thread.start()
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--mode', choices=['asyncio', 'threaded'], default='asyncio')
+    parser.add_argument('--no-gif', action='store_true', help='Only downloads the frames')
+    parser.add_argument('--buffer-size', type=int, default=CLIENT_BUFFER, help='Bytes read by one recv call')
+    parser.add_argument('--optimize', action='store_true',
+                        help='Makes unchanged pixels transparent and crops frames to the changed area')
+    parser.add_argument('--report', type=str, default=None, help='Writes the metrics of the run to this JSON file')
+    args = parser.parse_args()
 
-            [thread.join() for thread in threads]
+    # Frames go straight from the socket into the GIF, nothing is written to disk in between
+    gif_writer = None if args.no_gif else GifStreamWriter(open(FILE_NAME, 'wb'), duration=500, loop=0,
+                                                          optimize=args.optimize)
+    assembler = FrameAssembler(gif_writer)
+
+    t0 = time.time()
+    try:
+        if args.mode == 'asyncio':
+            asyncio.run(download_async(range(FRAME_COUNT), assembler))
+        else:
+            download_in_threads(range(FRAME_COUNT), assembler, args.buffer_size)
+        assembler.finish()
+    finally:
+        if gif_writer is not None:
+            gif_writer.close()
 
-        print(missing_frames_iters)
+    download_time = time.time() - t0
+    print(f'Frames download time: {download_time}')
+    if not args.no_gif:
+        print(f'Quantization time: {assembler.quantize_time}')
+        print(f'GIF creation time: {assembler.encode_time}')
 
-    print(f'Frames download time: {time.time() - t0}')
-    print(f'GIF creation time: {create_gif()}')
+    if args.report:
+        write_report(args.report, metrics.report(
+            settings=vars(args),
+            download_s=download_time,
+            frames_per_s=FRAME_COUNT / download_time,
+            bytes_per_s=metrics.counters['bytes'] / download_time,
+        ))
@@ -0,0 +1,156 @@
+import io
+import struct
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+SCREEN_DESCRIPTOR = struct.Struct('<HHBBB')  # Width, height, flags, background color, aspect ratio
+GRAPHIC_CONTROL = struct.Struct('<3sBHBB')  # Introducer, flags, delay in 1/100 s, transparent color, terminator
+IMAGE_DESCRIPTOR_SIZE = 10
+HAS_COLOR_TABLE = 0x80
+GLOBAL_TABLE_FLAGS = HAS_COLOR_TABLE | 0x70 | 0x07  # 8 bits per primary color, 256 entries
+DISPOSE_NONE = 0x04  # The next frame is drawn over this one
+HAS_TRANSPARENCY = 0x01
+TRANSPARENT_INDEX = 255
+LUT_BITS = 5  # Bits per channel of the RGB -> palette lookup table
+TRAILER = b'\x3b'
+
+
+def color_table_size(flags):
+    return 3 * 2 ** ((flags & 0x07) + 1)
+
+
+def skip_sub_blocks(data, pos):
+    # Returns the position right after the block terminator
+    while data[pos]:
+        pos += data[pos] + 1
+    return pos + 1
+
+
+def split_single_frame(data):
+    # Splits a single-frame GIF written by PIL into the color table, the image descriptor and the image data.
+    # The descriptor is changed to refer to the color table as to the local one of the frame
+    flags = data[10]
+    pos = 6 + SCREEN_DESCRIPTOR.size
+    color_table = b''
+    if flags & HAS_COLOR_TABLE:
+        color_table = data[pos:pos + color_table_size(flags)]
+        pos += len(color_table)
+
+    # Skipping the extensions (graphic control, comments) that PIL may have written
+    while data[pos] == 0x21:
+        pos = skip_sub_blocks(data, pos + 2)
+
+    if data[pos] != 0x2c:
+        raise ValueError('Image descriptor not found')
+    descriptor = bytearray(data[pos:pos + IMAGE_DESCRIPTOR_SIZE])
+    pos += IMAGE_DESCRIPTOR_SIZE
+    if descriptor[9] & HAS_COLOR_TABLE:
+        flags = descriptor[9]
+        color_table = data[pos:pos + color_table_size(flags)]
+        pos += len(color_table)
+    if not color_table:
+        raise ValueError('Frame has no color table')
+
+    # Keeping the interlace flag only
+    descriptor[9] = (descriptor[9] & 0x40) | HAS_COLOR_TABLE | (flags & 0x07)
+    # LZW minimum code size followed by the data sub-blocks
+    image_data = data[pos:skip_sub_blocks(data, pos + 1)]
+    return bytes(descriptor), color_table, image_data
+
+
+def build_palette(frames, colors=256):
+    # Computes one palette for all frames with median cut over the frames stacked into a single image
+    mosaic = Image.fromarray(frames.reshape(-1, frames.shape[2], 3), 'RGB')
+    quantized = mosaic.quantize(colors, method=Image.Quantize.MEDIANCUT)
+    palette = np.zeros((256, 3), dtype='uint8')
+    used = np.array(quantized.getpalette()[:colors * 3], dtype='uint8').reshape(-1, 3)
+    palette[:len(used)] = used
+    return palette, len(used)
+
+
+class PaletteMapper:
+    # Maps RGB pixels to the nearest palette color. The nearest color is precomputed once for every
+    # cell of a 5 bits per channel RGB cube, after that mapping a batch of frames is a single lookup
+    def __init__(self, palette, colors, workers=4):
+        levels = (np.arange(1 << LUT_BITS) << (8 - LUT_BITS)) + (1 << (7 - LUT_BITS))
+        grid = np.stack(np.meshgrid(levels, levels, levels, indexing='ij'), axis=-1).reshape(-1, 1, 3)
+        candidates = palette[:colors].astype('int32').reshape(1, -1, 3)
+        self.lut = np.concatenate([((part - candidates) ** 2).sum(axis=2).argmin(axis=1)
+                                   for part in np.array_split(grid, 16)]).astype('uint8')
+        self.workers = workers
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+
+    def map_part(self, frames):
+        cells = frames >> (8 - LUT_BITS)
+        keys = (cells[..., 0].astype('uint16') << 2 * LUT_BITS) | (cells[..., 1].astype('uint16') << LUT_BITS) \
+            | cells[..., 2]
+        return self.lut[keys]
+
+    def map(self, frames):
+        # (N, H, W, 3) RGB frames -> (N, H, W) palette indices, the batch is split between threads
+        if len(frames) < self.workers * 8:
+            return self.map_part(frames)
+        return np.concatenate(list(self.pool.map(self.map_part, np.array_split(frames, self.workers))))
+
+    def close(self):
+        self.pool.shutdown()
+
+
+class GifStreamWriter:
+    # Writes an animated GIF frame by frame, so frames never have to be kept in memory.
+    # All frames are indexed with one global palette; with `optimize` the pixels that did not change
+    # since the previous frame become transparent and every frame is cropped to the changed area
+    def __init__(self, fp, duration=500, loop=0, optimize=False):
+        self.fp = fp
+        self.delay = duration // 10
+        self.loop = loop
+        self.optimize = optimize
+        self.palette = None
+        self.previous = None
+        self.frame_count = 0
+
+    def write_header(self, width, height, palette):
+        self.palette = palette.tobytes()
+        self.fp.write(b'GIF89a')
+        self.fp.write(SCREEN_DESCRIPTOR.pack(width, height, GLOBAL_TABLE_FLAGS, 0, 0))
+        self.fp.write(self.palette)
+        # NETSCAPE2.0 application extension with the loop count
+        self.fp.write(b'\x21\xff\x0bNETSCAPE2.0\x03\x01' + struct.pack('<H', self.loop) + b'\x00')
+
+    def write_frame(self, indices):
+        left = top = 0
+        flags = DISPOSE_NONE if self.optimize else 0
+        if self.optimize and self.previous is not None:
+            changed = indices != self.previous
+            rows, cols = np.flatnonzero(changed.any(axis=1)), np.flatnonzero(changed.any(axis=0))
+            if not rows.size:
+                # A frame needs at least one pixel
+                rows = cols = np.zeros(1, dtype='int64')
+            top, bottom, left, right = rows[0], rows[-1] + 1, cols[0], cols[-1] + 1
+            indices_area = np.where(changed[top:bottom, left:right], indices[top:bottom, left:right],
+                                    TRANSPARENT_INDEX).astype('uint8')
+            flags |= HAS_TRANSPARENCY
+        else:
+            indices_area = indices
+        if self.optimize:
+            self.previous = indices
+
+        image = Image.fromarray(np.ascontiguousarray(indices_area), 'P')
+        image.putpalette(self.palette)
+        with io.BytesIO() as output:
+            # Without optimize PIL keeps the indices and the palette as they are
+            image.save(output, format='GIF', optimize=False)
+            descriptor, _, image_data = split_single_frame(output.getvalue())
+
+        # Placing the frame at its offset, it uses the global color table instead of the local one
+        descriptor = descriptor[:1] + struct.pack('<HH', left, top) + descriptor[5:9] + bytes([descriptor[9] & 0x40])
+        self.fp.write(GRAPHIC_CONTROL.pack(b'\x21\xf9\x04', flags, self.delay, TRANSPARENT_INDEX, 0))
+        self.fp.write(descriptor + image_data)
+        self.frame_count += 1
+
+    def close(self):
+        if self.frame_count:
+            self.fp.write(TRAILER)
+        self.fp.close()
@@ -0,0 +1,87 @@
+import json
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+
+class Histogram:
+    # Keeps every sample, runs of the lab are small enough for exact percentiles
+    def __init__(self):
+        self.values = []
+
+    def record(self, value):
+        self.values.append(value)
+
+    def summary(self):
+        if not self.values:
+            return {'count': 0}
+        return {
+            'count': len(self.values),
+            'mean': sum(self.values) / len(self.values),
+            'p50': percentile(self.values, 50),
+            'p99': percentile(self.values, 99),
+            'max': max(self.values),
+        }
+
+
+class Metrics:
+    # Counters and histograms of one process, shared by its threads and coroutines
+    def __init__(self):
+        self.counters = defaultdict(int)
+        self.histograms = defaultdict(Histogram)
+        self.started = time.monotonic()
+        self.lock = threading.Lock()
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    def record(self, name, value):
+        with self.lock:
+            self.histograms[name].record(value)
+
+    @contextmanager
+    def timer(self, name):
+        # Records the duration of the block in seconds
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - t)
+
+    def merge(self, other):
+        # Adds the samples of another process, e.g. of a server worker
+        with self.lock:
+            for name, value in other.counters.items():
+                self.counters[name] += value
+            for name, histogram in other.histograms.items():
+                self.histograms[name].values += histogram.values
+
+    def report(self, **extra):
+        with self.lock:
+            return {
+                'elapsed_s': time.monotonic() - self.started,
+                'counters': dict(self.counters),
+                'histograms': {name: histogram.summary() for name, histogram in self.histograms.items()},
+                **extra,
+            }
+
+    def __getstate__(self):
+        # The lock stays in the process, only the samples are sent to the parent
+        return {'counters': self.counters, 'histograms': self.histograms, 'started': self.started}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+
+def write_report(path, report):
+    # Sorted keys, so reports of different runs can be compared with diff
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
@@ -1,28 +1,196 @@
+import argparse
+import asyncio
+import multiprocessing
+import signal
 import socket
+import struct
 import threading
+import time
 import os
 import logging
+import queue
 import numpy as np
 import io
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait
 
 from PIL import Image
 
+from metrics import Metrics, write_report
+
 
 logging.basicConfig(level=logging.NOTSET)
 PORT = 1234
 FRAME_COUNT = 5000
+FRAME_SIZE = 10  # Width and height of a frame in pixels
+MAX_WORKERS = 32  # Connections that are served at the same time, the rest wait in the accept queue
+WRITE_BATCH = 64  # Frames joined into one write before yielding to other connections
+CACHE_BYTES = 256 << 20  # Memory for pre-rendered frames, random pixels do not compress, so a PNG is about as large
+RENDER_BATCH = 512  # Served frames that are re-rendered at once
+RENDER_BYTES = 32 << 20  # Largest random draw that is encoded at once
+SHUTDOWN_TIMEOUT = 5  # Seconds that open connections get to finish the request in progress
+SAMPLE_INTERVAL = 0.05  # Seconds between samples of the accept queue depth and active handlers
+
+REQUEST = struct.Struct('!I')  # Number of frames requested over the connection
+FRAME_HEADER = struct.Struct('!I')  # Length of the PNG that follows
+# Start of struct tcp_info: 8 single-byte fields, then rto, ato, snd_mss, rcv_mss, unacked and sacked.
+# For a listening socket unacked is the current length of the accept queue and sacked is the backlog
+TCP_INFO = struct.Struct('8x6I')
+
+
+def generate_random_images(count, frame_size=FRAME_SIZE):
+    # One random draw for the whole batch of frames
+    return np.random.randint(0, 255, (count, frame_size, frame_size, 3), dtype='uint8')
+
+
+def frame_bytes(frame_size):
+    return frame_size * frame_size * 3
+
+
+def cache_size(frame_size):
+    # Frames that fit into CACHE_BYTES, a cache never holds more frames than a client can request
+    return max(min(CACHE_BYTES // frame_bytes(frame_size), FRAME_COUNT), 1)
+
 
+def ignore_signals():
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
 
-def generate_random_image():
-    arr = np.random.randint(0, 255, (10, 10, 3), dtype='uint8')
-    img = Image.fromarray(arr, 'RGB')
 
-    with io.BytesIO() as output:
-        img.save(output, format='PNG')
+def encode_images(arr):
+    # Runs in the worker processes, returns the PNG of every frame in the batch
+    frames = []
+    for frame in arr:
+        with io.BytesIO() as output:
+            Image.fromarray(frame, 'RGB').save(output, format='PNG')
+            frames.append(output.getvalue())
+    return frames
+
+
+class FrameCache:
+    # Ring buffer of pre-rendered frames. Handlers only slice from it, a background thread
+    # re-renders the slots that were served in batches on a pool of processes.
+    # If frames are requested faster than they are rendered, the older ones are served again
+    def __init__(self, size=None, render_batch=RENDER_BATCH, workers=None, frame_size=FRAME_SIZE):
+        self.size = size or cache_size(frame_size)
+        self.frame_size = frame_size
+        self.render_batch = min(render_batch, self.size)
+        self.workers = workers or os.cpu_count()
+        # Ctrl+C reaches the whole process group, the pool is shut down by the server
+        self.pool = ProcessPoolExecutor(max_workers=self.workers, initializer=signal.signal,
+                                        initargs=(signal.SIGINT, signal.SIG_IGN))
+        self.frames = []
+        self.cursor = 0
+        self.served = 0  # Frames served since the last refill
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.refill, daemon=True)
+        self.running = True
+
+    def render(self, count):
+        # Drawn and encoded in chunks of at most RENDER_BYTES, so large frames do not need all the pixels at once
+        chunk = max(min(count, RENDER_BYTES // frame_bytes(self.frame_size)), 1)
+        frames = []
+        for start in range(0, count, chunk):
+            images = generate_random_images(min(chunk, count - start), self.frame_size)
+            parts = np.array_split(images, min(self.workers, len(images)))
+            frames += [frame for encoded in self.pool.map(encode_images, parts) for frame in encoded]
+        return frames
+
+    def start(self):
+        self.frames = self.render(self.size)
+        self.thread.start()
+
+    def take(self, count):
+        with self.condition:
+            frames = []
+            start = self.cursor
+            while len(frames) < count:
+                end = min(start + count - len(frames), self.size)
+                frames += self.frames[start:end]
+                start = end % self.size
+            self.cursor = start
+            self.served += count
+            if self.served >= self.render_batch:
+                self.condition.notify()
+            return frames
+
+    def refill(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.served >= self.render_batch or not self.running)
+                if not self.running:
+                    return
+                # Replacing the slots that were served since the last refill
+                count = min(self.served, self.size)
+                start = (self.cursor - count) % self.size
+                self.served = 0
+
+            with metrics.timer('encode_batch_s'):
+                frames = self.render(count)
+            metrics.count('encoded_frames', count)
 
-        raw_data = output.getvalue()
+            with self.condition:
+                for i, frame in enumerate(frames):
+                    self.frames[(start + i) % self.size] = frame
 
-        return raw_data
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.pool.shutdown(cancel_futures=True)
+
+
+class Counters:
+    # Request counters in shared memory, so the parent process can sum them over the worker processes.
+    # Every process only writes its own row
+    FIELDS = ('connections', 'requests', 'frames', 'bytes')
+
+    def __init__(self, processes=1):
+        self.processes = processes
+        self.values = multiprocessing.Array('Q', processes * len(self.FIELDS), lock=False)
+        self.row = 0
+        self.lock = threading.Lock()
+
+    def add(self, **counts):
+        offset = self.row * len(self.FIELDS)
+        with self.lock:
+            for field, count in counts.items():
+                self.values[offset + self.FIELDS.index(field)] += count
+
+    def totals(self, row=None):
+        rows = range(self.processes) if row is None else [row]
+        return {field: sum(self.values[r * len(self.FIELDS) + i] for r in rows)
+                for i, field in enumerate(self.FIELDS)}
+
+
+frame_cache = None
+counters = Counters()
+shutdown_flags = None  # Set by every worker process once it shuts down, read by the parent
+metrics = Metrics()
+
+
+def begin_shutdown():
+    # Further SIGINT or SIGTERM would interrupt the cleanup, Ctrl+C sends one to every process of the group
+    ignore_signals()
+    if shutdown_flags is not None:
+        shutdown_flags[counters.row] = 1
+
+
+def accept_queue_depth(sock):
+    info = sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, TCP_INFO.size)
+    return TCP_INFO.unpack(info)[4]
+
+
+def recv_exact(connection, size):
+    # Returns exactly `size` bytes, or b'' if the peer closed the connection before sending anything
+    data = bytearray()
+    while len(data) < size:
+        packet = connection.recv(size - len(data))
+        if not packet:
+            if data:
+                raise ConnectionError('Connection closed in the middle of a request')
+            return b''
+        data += packet
+    return bytes(data)
 
 
 def handle_connection(connection, address):
@@ -30,8 +198,18 @@ def handle_connection(connection, address):
     logger = logging.getLogger(f'{address}')
     try:
         logger.debug(f'Connected to {connection}')
-        raw_image = generate_random_image()
-        connection.sendall(raw_image)
+        counters.add(connections=1)
+        # The connection stays open until the client closes it, every request is answered
+        # with the requested number of length-prefixed frames
+        while request := recv_exact(connection, REQUEST.size):
+            frame_count, = REQUEST.unpack(request)
+            counters.add(requests=1)
+            with metrics.timer('request_s'):
+                for start in range(0, frame_count, WRITE_BATCH):
+                    frames = frame_cache.take(min(WRITE_BATCH, frame_count - start))
+                    data = b''.join(FRAME_HEADER.pack(len(frame)) + frame for frame in frames)
+                    connection.sendall(data)
+                    counters.add(frames=len(frames), bytes=len(data))
     except Exception as err:
         logger.exception(f'Exception occurred: {err}')
     except KeyboardInterrupt:
@@ -42,46 +220,254 @@ def handle_connection(connection, address):
         connection.close()
 
 
+async def handle_stream(reader, writer):
+    logger = logging.getLogger(f'{writer.get_extra_info("peername")}')
+    try:
+        logger.debug('Connected')
+        counters.add(connections=1)
+        while True:
+            try:
+                frame_count, = REQUEST.unpack(await reader.readexactly(REQUEST.size))
+            except asyncio.IncompleteReadError:
+                # The client has closed the connection
+                break
+            counters.add(requests=1)
+            with metrics.timer('request_s'):
+                for start in range(0, frame_count, WRITE_BATCH):
+                    # Frames are joined into one write, the transport sends every write right away (TCP_NODELAY)
+                    frames = frame_cache.take(min(WRITE_BATCH, frame_count - start))
+                    data = b''.join(FRAME_HEADER.pack(len(frame)) + frame for frame in frames)
+                    writer.write(data)
+                    counters.add(frames=len(frames), bytes=len(data))
+                    # Waiting only when the send buffer is above the high-water mark
+                    await writer.drain()
+    except Exception as err:
+        logger.exception(f'Exception occurred: {err}')
+    finally:
+        logger.debug('Closing socket connection')
+        writer.close()
+
+
+class AsyncServer:
+    def __init__(self, server_ip, server_port, reuse_port=False):
+        self.server = None
+        self.logger = logging.getLogger('server')
+        self.server_ip = server_ip
+        self.server_port = server_port
+        self.reuse_port = reuse_port
+        self.streams = {}  # handler task -> reader
+
+    def listener(self):
+        return self.server.sockets[0] if self.server is not None and self.server.sockets else None
+
+    def active_handlers(self):
+        return len(self.streams)
+
+    async def handle(self, reader, writer):
+        task = asyncio.current_task()
+        self.streams[task] = reader
+        try:
+            await handle_stream(reader, writer)
+        finally:
+            del self.streams[task]
+
+    async def start(self):
+        stopping = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stopping.set)
+
+        # Every connection is a coroutine on one event loop instead of a thread
+        self.server = await asyncio.start_server(self.handle, self.server_ip or None, self.server_port,
+                                                 backlog=FRAME_COUNT, reuse_address=True, reuse_port=self.reuse_port)
+        await stopping.wait()
+        # Removed before the loop closes, which would restore the default handlers
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.remove_signal_handler(sig)
+        begin_shutdown()
+
+        # Graceful shutdown: no new connections are accepted, the open ones are closed
+        # once the request in progress is answered
+        self.logger.info('Shutting down...')
+        self.server.close()
+        for reader in self.streams.values():
+            reader.feed_eof()
+        if self.streams:
+            await asyncio.wait(list(self.streams), timeout=SHUTDOWN_TIMEOUT)
+
+
 class Server:
-    def __init__(self, server_ip, server_port):
+    def __init__(self, server_ip, server_port, max_workers=MAX_WORKERS, reuse_port=False):
         self.socket = None
         self.logger = logging.getLogger('server')
         self.server_ip = server_ip
         self.server_port = server_port
+        self.reuse_port = reuse_port
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.connections = set()
+        self.futures = set()
+        self.lock = threading.Lock()
+
+    def listener(self):
+        return self.socket
+
+    def active_handlers(self):
+        return len(self.connections)
+
+    def handle(self, connection, address):
+        with self.lock:
+            self.connections.add(connection)
+        try:
+            handle_connection(connection, address)
+        finally:
+            with self.lock:
+                self.connections.discard(connection)
 
     def start(self):
         self.socket = socket.socket(family=socket.AF_INET, type=socket.SOCK_STREAM)
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            # Every worker process listens on the same port, the kernel spreads connections between them
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.socket.bind((self.server_ip, self.server_port))
         self.socket.listen(FRAME_COUNT)
-        thread_count = 0
+        connection_count = 0
 
         while True:
             connection, address = self.socket.accept()
 
-            # Creating separate thread for each connection
-            thread = threading.Thread(target=handle_connection, args=(connection, address))
-            thread.daemon = True
-            thread.start()
-            thread_count += 1
+            # Handling connections on a bounded pool of threads
+            future = self.executor.submit(self.handle, connection, address)
+            self.futures.add(future)
+            future.add_done_callback(self.futures.discard)
+            connection_count += 1
 
-            self.logger.debug(f"Started thread {thread}: {thread_count}")
+            self.logger.debug(f"Accepted connection {address}: {connection_count}")
 
+    def stop(self):
+        if self.socket is not None:
+            self.socket.close()
+        # Graceful shutdown: closing the connections for reading ends every handler
+        # once the request in progress is answered
+        with self.lock:
+            for connection in self.connections:
+                try:
+                    connection.shutdown(socket.SHUT_RD)
+                except OSError:
+                    pass
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        wait(list(self.futures), timeout=SHUTDOWN_TIMEOUT)
+
+
+def sample(server, stopped):
+    # Samples the load of the server until `stopped` is set
+    while not stopped.wait(SAMPLE_INTERVAL):
+        metrics.record('active_handlers', server.active_handlers())
+        if (sock := server.listener()) is not None:
+            try:
+                metrics.record('accept_queue', accept_queue_depth(sock))
+            except OSError:
+                pass
 
-if __name__ == '__main__':
-    server = Server('', PORT)
-    try:
-        if not os.path.exists('frames'):
-            os.mkdir('frames')
 
+def serve(mode, frame_size=FRAME_SIZE, cache_workers=None, reuse_port=False):
+    # Runs the server in this process until SIGINT or SIGTERM
+    global frame_cache
+    # The cache starts its worker processes before any connection threads exist
+    frame_cache = FrameCache(workers=cache_workers, frame_size=frame_size)
+    if mode == 'threaded':
+        server = Server('', PORT, reuse_port=reuse_port)
+    else:
+        server = AsyncServer('', PORT, reuse_port=reuse_port)
+    stopped = threading.Event()
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        logging.info('Rendering frames...')
+        with metrics.timer('startup_render_s'):
+            frame_cache.start()
         logging.info('Listening...')
-        server.start()
+        threading.Thread(target=sample, args=(server, stopped)).start()
+        if mode == 'threaded':
+            server.start()
+        else:
+            asyncio.run(server.start())
+    except KeyboardInterrupt:
+        logging.info('Received interrupt, shutting down...')
     except Exception as error:
         logging.exception(f'Exception occurred: {error}')
     finally:
+        begin_shutdown()
+        stopped.set()
+        if mode == 'threaded':
+            server.stop()
+        frame_cache.stop()
         for t in threading.enumerate():
             if t is threading.main_thread():
                 continue
             t.join()
 
-        logging.info('Terminating...')
+
+def serve_worker(index, mode, frame_size, cache_workers, reports):
+    counters.row = index
+    serve(mode, frame_size, cache_workers, reuse_port=True)
+    logging.info(f'Worker {index} served: {counters.totals(index)}')
+    reports.put(metrics)
+
+
+def serve_processes(processes, mode, frame_size):
+    # Forks worker processes that share the listening port with SO_REUSEPORT, each one has its own
+    # frame cache and event loop or thread pool, so frames are served without a shared GIL
+    global counters, shutdown_flags
+    counters = Counters(processes)
+    shutdown_flags = multiprocessing.Array('b', processes, lock=False)
+    cache_workers = max(os.cpu_count() // processes, 1)
+    context = multiprocessing.get_context('fork')
+    reports = context.Queue()
+    workers = [context.Process(target=serve_worker, args=(i, mode, frame_size, cache_workers, reports))
+               for i in range(processes)]
+    for worker in workers:
+        worker.start()
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        logging.info('Received interrupt, stopping the workers...')
+    finally:
+        ignore_signals()
+        # Workers finish the requests in progress on SIGTERM. After Ctrl+C they are already shutting down,
+        # a second signal would interrupt them
+        for i, worker in enumerate(workers):
+            if worker.is_alive() and not shutdown_flags[i]:
+                worker.terminate()
+        # Metrics of the workers are collected before joining them, a worker exits once its queue is flushed
+        deadline = time.monotonic() + SHUTDOWN_TIMEOUT * 2
+        for _ in workers:
+            try:
+                metrics.merge(reports.get(timeout=max(deadline - time.monotonic(), 0)))
+            except queue.Empty:
+                logging.warning('A worker did not report its metrics')
+        for worker in workers:
+            worker.join(SHUTDOWN_TIMEOUT * 2)
+            if worker.is_alive():
+                worker.kill()
+                worker.join()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--mode', choices=['asyncio', 'threaded'], default='asyncio')
+    parser.add_argument('--frame-size', type=int, default=FRAME_SIZE, help='Width and height of frames in pixels')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='Worker processes that share the port, every one serves in the given mode')
+    parser.add_argument('--report', type=str, default=None, help='Writes the metrics of the run to this JSON file')
+    args = parser.parse_args()
+
+    if args.processes > 1:
+        serve_processes(args.processes, args.mode, args.frame_size)
+    else:
+        serve(args.mode, args.frame_size)
+    logging.info(f'Served: {counters.totals()}')
+    if args.report:
+        write_report(args.report, metrics.report(settings=vars(args), served=counters.totals()))
+    logging.info('Terminating...')
@@ -0,0 +1,324 @@
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import queue
+import random
+import re
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+from pika import BlockingConnection, ConnectionParameters, PlainCredentials
+
+LAB_DIR = os.path.dirname(os.path.abspath(__file__))
+RECEIVER_PATH = os.path.join(LAB_DIR, 'subscribers', 'receiver.py')
+REPORTER_PATH = os.path.join(LAB_DIR, 'subscribers', 'reporter.py')
+sys.path.insert(0, os.path.join(LAB_DIR, 'subscribers'))
+
+import receiver  # noqa: E402
+import reporter  # noqa: E402
+from segments import SegmentWriter, list_segments, read_segments  # noqa: E402
+from tsdb import TimeSeriesStore  # noqa: E402
+
+EXCHANGE_NAME = 'amq.topic'
+POLL_INTERVAL = 0.005  # Seconds between reads of the log, adds up to this much to the measured latencies
+DRAIN_TIMEOUT = 10  # Seconds to wait for the published readings to reach the log
+QUERY_TIMEOUT = 5
+STARTUP_TIME = 1  # Seconds the receivers get to start consuming
+PERCENTILES = [50, 99, 99.9]
+# Queries the reporter answers with exactly one line, the rabbitmq mode times a query until its answer is printed
+ONE_LINE_QUERIES = ['current', 'range']
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+
+def summary(latencies):
+    # Count and percentiles in milliseconds
+    if not latencies:
+        return {'count': 0}
+    result = {'count': len(latencies)}
+    for p in PERCENTILES:
+        result[f'p{p:g}_ms'] = round(percentile(latencies, p) * 1000, 3)
+    result['max_ms'] = round(max(latencies) * 1000, 3)
+    return result
+
+
+def make_reading(sensors):
+    # Same routing keys and message as sensor.py, the time in the message is the publish time
+    sensor_id = f'sensor{random.randrange(sensors)}'
+    body = json.dumps({'time': datetime.now().__str__(), 'sensor': sensor_id, 'value': random.randint(300, 700)})
+    return f'co2.{sensor_id}', body.encode()
+
+
+def pacing_delay(i, start, rate):
+    # Seconds to wait before the i-th reading to keep `rate` readings per second, 0 publishes as fast as possible
+    return start + i / rate - time.monotonic() if rate else 0
+
+
+class LogTailer(threading.Thread):
+    # Polls the log shards of the receivers and measures the time from publishing a reading until it is on disk
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.positions = {}  # shard -> (segment, offset)
+        self.latencies = []
+        self.running = True
+
+    def poll(self):
+        now = time.time()
+        for shard in sorted({shard for shard, _, _ in list_segments()}):
+            segment, offset = self.positions.get(shard, (0, 0))
+            for reading, segment, offset in read_segments(shard, segment, offset):
+                self.latencies.append(now - datetime.fromisoformat(reading['time']).timestamp())
+            self.positions[shard] = (segment, offset)
+
+    def wait_for(self, count, timeout=DRAIN_TIMEOUT):
+        deadline = time.monotonic() + timeout
+        while len(self.latencies) < count and time.monotonic() < deadline:
+            time.sleep(POLL_INTERVAL)
+
+    def run(self):
+        while self.running:
+            self.poll()
+            time.sleep(POLL_INTERVAL)
+
+    def stop(self):
+        self.running = False
+        self.join()
+
+
+def topic_pattern(routing_key):
+    # AMQP topic binding -> regular expression: * is one word, # is any number of words
+    words = [{'*': r'[^.]+', '#': r'.*'}.get(word, re.escape(word)) for word in routing_key.split('.')]
+    return re.compile(r'\.'.join(words) + '$')
+
+
+class StandInBroker:
+    # Topic exchange and queues in the memory of the benchmark, for machines without RabbitMQ.
+    # Consumers of a queue compete for its messages like receivers of the shared queue do,
+    # up to `concurrency` handlers of a consumer run at the same time. There is no network and no acks
+    def __init__(self):
+        self.queues = {}
+        self.bindings = []  # (pattern, queue)
+        self.workers = []
+
+    def declare(self, name, routing_key):
+        self.queues[name] = asyncio.Queue()
+        self.bindings.append((topic_pattern(routing_key), self.queues[name]))
+
+    def consume(self, name, handler, concurrency):
+        async def work():
+            while True:
+                body = await self.queues[name].get()
+                try:
+                    await handler(body)
+                finally:
+                    self.queues[name].task_done()
+
+        self.workers += [asyncio.ensure_future(work()) for _ in range(concurrency)]
+
+    def publish(self, routing_key, body):
+        for pattern, messages in self.bindings:
+            if pattern.match(routing_key):
+                messages.put_nowait(body)
+
+    async def drain(self):
+        await asyncio.gather(*(messages.join() for messages in self.queues.values()))
+
+    def close(self):
+        for worker in self.workers:
+            worker.cancel()
+
+
+async def run_in_process(args, tailer):
+    broker = StandInBroker()
+    broker.declare(receiver.QUEUE_NAME, receiver.ROUTING_KEY)
+    broker.declare('reporter', reporter.ROUTING_KEY)
+
+    writers = [SegmentWriter(str(i), args.binary) for i in range(args.receivers)]
+    for writer in writers:
+        handler = receiver.AsyncReceiver(writer, min(receiver.FLUSH_RECORDS, args.concurrency)).handle
+        broker.consume(receiver.QUEUE_NAME, handler, args.concurrency)
+
+    reporter.aggregates, reporter.store = reporter.Aggregates(), TimeSeriesStore()
+    reporter.query_lock = asyncio.Lock()
+    answered = asyncio.Event()
+
+    async def answer(body):
+        await reporter.handle(body)
+        answered.set()
+
+    broker.consume('reporter', answer, 1)
+
+    query_latencies = []
+    publishing = True
+
+    async def query():
+        while publishing:
+            await asyncio.sleep(args.query_interval)
+            answered.clear()
+            t = time.perf_counter()
+            broker.publish(f'rep.{args.query.split()[0]}', args.query.encode())
+            await answered.wait()
+            query_latencies.append(time.perf_counter() - t)
+
+    querying = asyncio.ensure_future(query())
+    start = time.monotonic()
+    for i in range(args.count):
+        if (delay := pacing_delay(i, start, args.rate)) > 0:
+            await asyncio.sleep(delay)
+        elif i % 1000 == 0:
+            # Letting the consumers run while publishing as fast as possible
+            await asyncio.sleep(0)
+        broker.publish(*make_reading(args.sensors))
+    elapsed = time.monotonic() - start
+    publishing = False
+
+    await asyncio.wait_for(broker.drain(), DRAIN_TIMEOUT)
+    await querying
+    broker.close()
+    for writer in writers:
+        writer.close()
+    return elapsed, query_latencies
+
+
+def run_rabbitmq(args, tailer):
+    parameters = ConnectionParameters(
+        host=receiver.RMQ_HOST,
+        credentials=PlainCredentials(receiver.RMQ_USER, receiver.RMQ_PASS)
+    )
+    connection = BlockingConnection(parameters)
+    channel = connection.channel()
+    # Readings left in the shared queue by a previous run would distort the latencies
+    channel.queue_declare(queue=receiver.QUEUE_NAME, durable=True)
+    channel.queue_purge(queue=receiver.QUEUE_NAME)
+
+    flags = ['--async', '--concurrency', str(args.concurrency)] if args.async_mode else []
+    flags += ['--binary'] if args.binary else []
+    receivers = [subprocess.Popen([sys.executable, RECEIVER_PATH, '--shard', str(i), *flags],
+                                  stdout=subprocess.DEVNULL) for i in range(args.receivers)]
+    reporter_process = subprocess.Popen([sys.executable, '-u', REPORTER_PATH], stdout=subprocess.PIPE, text=True)
+    lines = queue.Queue()
+    threading.Thread(target=lambda: [lines.put(line) for line in reporter_process.stdout], daemon=True).start()
+
+    query_latencies = []
+    publishing = threading.Event()
+    publishing.set()
+
+    def query():
+        # pika connections may not be shared between threads
+        query_connection = BlockingConnection(parameters)
+        query_channel = query_connection.channel()
+        while publishing.is_set():
+            time.sleep(args.query_interval)
+            # A late answer to a query that timed out is not taken for the answer to this one
+            while not lines.empty():
+                lines.get_nowait()
+            t = time.perf_counter()
+            query_channel.basic_publish(exchange=EXCHANGE_NAME, routing_key=f'rep.{args.query.split()[0]}',
+                                        body=args.query.encode())
+            try:
+                lines.get(timeout=QUERY_TIMEOUT)
+                query_latencies.append(time.perf_counter() - t)
+            except queue.Empty:
+                print('Benchmark: A query was not answered')
+        query_connection.close()
+
+    try:
+        lines.get(timeout=QUERY_TIMEOUT)  # The reporter is consuming
+        time.sleep(STARTUP_TIME)
+        querying = threading.Thread(target=query)
+        querying.start()
+
+        start = time.monotonic()
+        for i in range(args.count):
+            if (delay := pacing_delay(i, start, args.rate)) > 0:
+                time.sleep(delay)
+            routing_key, body = make_reading(args.sensors)
+            channel.basic_publish(exchange=EXCHANGE_NAME, routing_key=routing_key, body=body)
+        elapsed = time.monotonic() - start
+        publishing.clear()
+        tailer.wait_for(args.count)
+        querying.join()
+    finally:
+        connection.close()
+        # Receivers flush their last group on SIGINT
+        for process in [*receivers, reporter_process]:
+            process.send_signal(signal.SIGINT)
+        for process in [*receivers, reporter_process]:
+            try:
+                process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                process.kill()
+    return elapsed, query_latencies
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measures publish rate, publish-to-log latency and query latency '
+                                                 'of the lab3 pipeline')
+    parser.add_argument('--broker', choices=['in-process', 'rabbitmq'], default='in-process',
+                        help='in-process runs the receiver and reporter code on a stand-in broker, rabbitmq runs '
+                             'receiver.py and reporter.py against the broker from docker-compose.yml')
+    parser.add_argument('--count', type=int, default=100000, help='Readings to publish')
+    parser.add_argument('--sensors', type=int, default=1000, help='Simulated sensors, each has its own routing key')
+    parser.add_argument('--rate', type=float, default=0, help='Readings per second, 0 publishes as fast as possible')
+    parser.add_argument('--receivers', type=int, default=1)
+    parser.add_argument('--async', dest='async_mode', action='store_true', help='Runs the receivers with --async')
+    parser.add_argument('--concurrency', type=int, default=receiver.CONCURRENCY,
+                        help='Handlers of a receiver that run at the same time')
+    parser.add_argument('--binary', action='store_true', help='Receivers write binary records')
+    parser.add_argument('--query', type=str, default='current',
+                        help='Query sent by the simulated control tower, only current and range with --broker rabbitmq')
+    parser.add_argument('--query-interval', type=float, default=0.1, help='Seconds between queries')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--json', type=str, default=None, help='Writes the results to this file')
+    args = parser.parse_args()
+    if args.broker == 'rabbitmq' and args.query.split()[0] not in ONE_LINE_QUERIES:
+        # Answers of other queries span several lines (or none), so they could not be matched to their queries
+        parser.error(f'--query must be one of {", ".join(ONE_LINE_QUERIES)} with --broker rabbitmq')
+
+    random.seed(args.seed)
+    with tempfile.TemporaryDirectory() as workdir:
+        # Receivers and the reporter keep their files in the working directory
+        os.chdir(workdir)
+        tailer = LogTailer()
+        tailer.start()
+        try:
+            if args.broker == 'in-process':
+                # The receiver prints every reading
+                with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                    elapsed, query_latencies = asyncio.run(run_in_process(args, tailer))
+            else:
+                elapsed, query_latencies = run_rabbitmq(args, tailer)
+            tailer.wait_for(args.count)
+        except KeyboardInterrupt:
+            print('Benchmark: Exiting...')
+            exit()
+        finally:
+            tailer.stop()
+            os.chdir(LAB_DIR)
+
+    results = {
+        'settings': vars(args),
+        'published': args.count,
+        'publish_rate': round(args.count / elapsed, 1),
+        'logged': len(tailer.latencies),
+        'log_latency': summary(tailer.latencies),
+        'query_latency': summary(query_latencies),
+    }
+    print(f'Published {args.count} readings in {elapsed:.3f}s: {results["publish_rate"]} readings/s, '
+          f'{results["logged"]} reached the log')
+    for name in ['log_latency', 'query_latency']:
+        print(f'{name:>14}: ' + ', '.join(f'{key} {value}' for key, value in results[name].items()))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
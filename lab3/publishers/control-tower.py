@@ -5,6 +5,14 @@ RMQ_HOST = 'localhost'
 RMQ_USER = 'rabbit'
 RMQ_PASS = '1234'
 EXCHANGE_NAME = 'amq.topic'
+# Query name -> allowed numbers of parameters. Times are 'now', a duration before now like -15m,
+# or an ISO date and time; steps are seconds with an optional s, m, h or d unit
+QUERIES = {
+    'current': [0],
+    'average': [0],
+    'range': [1, 2],  # range <start> [<end>]
+    'downsample': [3],  # downsample <start> <end> <step>
+}
 
 if __name__ == '__main__':
     connection = BlockingConnection(
@@ -15,7 +23,9 @@ if __name__ == '__main__':
     )
     try:
         while True:
-            assert (query := input('Enter Query: ').strip()) in ['current', 'average']
+            query = input('Enter Query: ').strip()
+            name, *params = query.split() or ['']
+            assert name in QUERIES and len(params) in QUERIES[name]
             channel = connection.channel()
 
             channel.exchange_declare(
@@ -26,7 +36,7 @@ if __name__ == '__main__':
 
             channel.basic_publish(
                 exchange=EXCHANGE_NAME,
-                routing_key=f'rep.{query}',
+                routing_key=f'rep.{name}',
                 body=query.encode()
             )
     except KeyboardInterrupt:
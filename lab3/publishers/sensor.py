@@ -1,47 +1,185 @@
+import argparse
 import json
+import random
+import sys
+import time
+from collections import OrderedDict, deque
 from datetime import datetime
+from itertools import islice, takewhile
 
-from pika import BlockingConnection, ConnectionParameters, PlainCredentials
+from pika import BlockingConnection, ConnectionParameters, PlainCredentials, SelectConnection
 from pika.exchange_type import ExchangeType
+from pika.spec import Basic
 
 RMQ_HOST = 'localhost'
 RMQ_USER = 'rabbit'
 RMQ_PASS = '1234'
 EXCHANGE_NAME = 'amq.topic'
-ROUTING_KEY = 'co2.sensor'
+ROUTING_KEY = 'co2.{}'  # Every sensor publishes with its own routing key
+SENSOR_ID = 'sensor'
+WINDOW = 1000  # Published readings that may wait for a confirm from the broker
 
-if __name__ == '__main__':
-    connection = BlockingConnection(
-        ConnectionParameters(
-            host=RMQ_HOST,
-            credentials=PlainCredentials(RMQ_USER, RMQ_PASS)
+
+def make_message(sensor_id, value):
+    # Returns the routing key and the body of the reading
+    body = json.dumps({'time': datetime.now().__str__(), 'sensor': sensor_id, 'value': value}).encode()
+    return ROUTING_KEY.format(sensor_id), body
+
+
+def read_values(f, sensor_id):
+    # One CO2 level per line, empty lines are skipped
+    for line in f:
+        if line := line.strip():
+            yield sensor_id, int(line)
+
+
+def random_values(count, sensors):
+    # Readings of `sensors` sensors in random order
+    return ((f'{SENSOR_ID}{random.randrange(sensors)}', random.randint(300, 700)) for _ in range(count))
+
+
+class ConfirmPublisher:
+    # Publishes readings with publisher confirms. Up to `window` messages may be unconfirmed,
+    # the broker acks them cumulatively, so publishing does not wait for a round trip per reading.
+    # Nacked readings are published again
+    def __init__(self, parameters, values, window=WINDOW):
+        self.parameters = parameters
+        self.values = iter(values)
+        self.window = window
+        self.connection = self.channel = None
+        self.unconfirmed = OrderedDict()  # delivery tag -> (routing key, body)
+        self.retries = deque()
+        self.next_tag = 1
+        self.exhausted = False
+        self.published = self.confirmed = self.nacked = 0
+
+    def run(self):
+        self.connection = SelectConnection(self.parameters, on_open_callback=self.on_connection_open,
+                                           on_open_error_callback=self.on_connection_error,
+                                           on_close_callback=self.on_connection_closed)
+        try:
+            self.connection.ioloop.start()
+        except KeyboardInterrupt:
+            print('Received Interrupt. Exiting...')
+            if not self.connection.is_closed:
+                self.connection.close()
+                # Letting the connection close cleanly
+                self.connection.ioloop.start()
+
+    def on_connection_open(self, connection):
+        connection.channel(on_open_callback=self.on_channel_open)
+
+    def on_connection_error(self, connection, error):
+        print(f'Connection failed: {error}')
+        connection.ioloop.stop()
+
+    def on_connection_closed(self, connection, reason):
+        connection.ioloop.stop()
+
+    def on_channel_open(self, channel):
+        # The channel and the exchange are declared once for the whole stream
+        self.channel = channel
+        channel.exchange_declare(
+            exchange=EXCHANGE_NAME,
+            exchange_type=ExchangeType.topic.name,
+            durable=True,
+            callback=lambda _: channel.confirm_delivery(self.on_confirm, callback=lambda _: self.publish())
         )
-    )
 
-    try:
-        while True:
-            value = int(input('Enter CO2 level: '))
+    def publish(self):
+        # Filling the window, the next readings are taken in a batch only when there is room for them
+        room = self.window - len(self.unconfirmed)
+        messages = [self.retries.popleft() for _ in range(min(room, len(self.retries)))]
+        if not self.exhausted and len(messages) < room:
+            values = list(islice(self.values, room - len(messages)))
+            self.exhausted = len(values) < room - len(messages)
+            messages += (make_message(sensor_id, value) for sensor_id, value in values)
 
-            channel = connection.channel()
-            channel.exchange_declare(
-                exchange=EXCHANGE_NAME,
-                exchange_type=ExchangeType.topic.name,
-                durable=True
-            )
+        for routing_key, body in messages:
+            self.channel.basic_publish(exchange=EXCHANGE_NAME, routing_key=routing_key, body=body)
+            self.unconfirmed[self.next_tag] = routing_key, body
+            self.next_tag += 1
+        self.published += len(messages)
+
+        if self.exhausted and not self.unconfirmed and not self.retries:
+            self.connection.close()
 
-            curr_time = datetime.now().__str__()
+    def on_confirm(self, frame):
+        method = frame.method
+        if method.multiple:
+            # Tags are kept in increasing order, the confirm covers every one up to its tag
+            tags = list(takewhile(lambda tag: tag <= method.delivery_tag, self.unconfirmed))
+        else:
+            tags = [method.delivery_tag] if method.delivery_tag in self.unconfirmed else []
+        messages = [self.unconfirmed.pop(tag) for tag in tags]
 
-            msg = {
-                'time': curr_time,
-                'value': value
-            }
+        if isinstance(method, Basic.Ack):
+            self.confirmed += len(messages)
+        else:
+            self.nacked += len(messages)
+            self.retries.extend(messages)
+        self.publish()
+
+
+def publish_interactive(parameters, sensor_id):
+    connection = BlockingConnection(parameters)
+    try:
+        channel = connection.channel()
+        channel.exchange_declare(
+            exchange=EXCHANGE_NAME,
+            exchange_type=ExchangeType.topic.name,
+            durable=True
+        )
+
+        while True:
+            value = int(input('Enter CO2 level: '))
+            routing_key, body = make_message(sensor_id, value)
 
             channel.basic_publish(
                 exchange=EXCHANGE_NAME,
-                routing_key=ROUTING_KEY,
-                body=json.dumps(msg).encode()
+                routing_key=routing_key,
+                body=body
             )
     except KeyboardInterrupt:
         print('Received Interrupt. Exiting...')
     finally:
         connection.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument('--file', type=str, default=None,
+                        help='Publishes the CO2 levels from this file, one per line ("-" for stdin)')
+    source.add_argument('--generate', type=int, default=None, help='Publishes this many random CO2 levels')
+    parser.add_argument('--window', type=int, default=WINDOW, help='Readings that may wait for a confirm')
+    parser.add_argument('--sensor-id', type=str, default=SENSOR_ID, help='Publishes with the routing key co2.<id>')
+    parser.add_argument('--sensors', type=int, default=1,
+                        help='With --generate, spreads the readings over this many sensor ids')
+    args = parser.parse_args()
+    if '.' in args.sensor_id:
+        parser.error('Sensor id may not contain dots, receivers bind co2.*')
+
+    parameters = ConnectionParameters(
+        host=RMQ_HOST,
+        credentials=PlainCredentials(RMQ_USER, RMQ_PASS)
+    )
+
+    if args.file is None and args.generate is None:
+        publish_interactive(parameters, args.sensor_id)
+    else:
+        f = sys.stdin if args.file in (None, '-') else open(args.file)
+        if args.generate is not None:
+            values = random_values(args.generate, max(args.sensors, 1))
+        else:
+            values = read_values(f, args.sensor_id)
+
+        publisher = ConfirmPublisher(parameters, values, max(args.window, 1))
+        t = time.time()
+        try:
+            publisher.run()
+        finally:
+            f.close()
+        elapsed = time.time() - t
+        print(f'Published {publisher.published} readings ({publisher.nacked} nacked and published again), '
+              f'{publisher.confirmed} confirmed in {elapsed:.3f}s: {publisher.confirmed / elapsed:.0f} readings/s')
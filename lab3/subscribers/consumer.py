@@ -0,0 +1,93 @@
+import asyncio
+
+from pika.adapters.asyncio_connection import AsyncioConnection
+from pika.exchange_type import ExchangeType
+
+PREFETCH = 1000  # Unacknowledged messages the broker sends ahead
+CONCURRENCY = 1000  # Handlers that run at the same time
+SHUTDOWN_TIMEOUT = 5  # Seconds the running handlers get to finish on exit
+MALFORMED = (ValueError, KeyError, TypeError)  # Errors of messages that could not be decoded, they would fail again
+
+
+class AsyncConsumer:
+    # Consumes a queue on an asyncio event loop. The broker delivers up to `prefetch` messages ahead,
+    # up to `concurrency` handlers run at the same time, and every message is acked once its handler
+    # returns. Messages of a slow handler stay unacknowledged, so the broker stops delivering (backpressure)
+    def __init__(self, parameters, exchange, routing_key, handler, queue='', durable=False,
+                 prefetch=PREFETCH, concurrency=CONCURRENCY):
+        self.parameters = parameters
+        self.exchange = exchange
+        self.routing_key = routing_key
+        self.handler = handler
+        self.queue = queue
+        self.durable = durable
+        self.prefetch = prefetch
+        self.concurrency = concurrency
+        self.connection = self.channel = None
+        self.closed = None
+        self.semaphore = None
+        self.tasks = set()
+
+    @staticmethod
+    async def call(method, **kwargs):
+        # Awaits an asynchronous pika method that reports completion with a callback
+        future = asyncio.get_running_loop().create_future()
+        method(callback=future.set_result, **kwargs)
+        return await future
+
+    async def connect(self):
+        loop = asyncio.get_running_loop()
+        opened, channel = loop.create_future(), loop.create_future()
+        self.closed = loop.create_future()
+        self.connection = AsyncioConnection(
+            self.parameters,
+            on_open_callback=opened.set_result,
+            on_open_error_callback=lambda _, error: opened.set_exception(ConnectionError(error)),
+            on_close_callback=lambda _, reason: self.closed.done() or self.closed.set_result(reason),
+            custom_ioloop=loop
+        )
+        await opened
+        self.connection.channel(on_open_callback=channel.set_result)
+        self.channel = await channel
+
+        await self.call(self.channel.exchange_declare, exchange=self.exchange,
+                        exchange_type=ExchangeType.topic.name, durable=True)
+        frame = await self.call(self.channel.queue_declare, queue=self.queue, durable=self.durable,
+                                exclusive=not self.queue)
+        queue = frame.method.queue
+        await self.call(self.channel.queue_bind, queue=queue, exchange=self.exchange, routing_key=self.routing_key)
+        await self.call(self.channel.basic_qos, prefetch_count=self.prefetch)
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        self.channel.basic_consume(queue=queue, on_message_callback=self.on_message)
+
+    def on_message(self, channel, method, properties, body):
+        task = asyncio.ensure_future(self.process(method.delivery_tag, body))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def process(self, delivery_tag, body):
+        async with self.semaphore:
+            try:
+                await self.handler(body)
+            except Exception as err:
+                # Only malformed messages are dropped, the others (e.g. of a failing disk) are delivered again
+                requeue = not isinstance(err, MALFORMED)
+                print(f'Failed to handle a message{", requeueing it" if requeue else ""}: {err}')
+                if self.channel.is_open:
+                    self.channel.basic_nack(delivery_tag=delivery_tag, requeue=requeue)
+                return
+        if self.channel.is_open:
+            self.channel.basic_ack(delivery_tag=delivery_tag)
+
+    async def run(self):
+        await self.connect()
+        try:
+            # Shielded, so that cancelling the consumer does not cancel waiting for the connection to close
+            await asyncio.shield(self.closed)
+        finally:
+            # Letting the running handlers finish, the messages they did not get to are redelivered
+            if self.tasks:
+                await asyncio.wait(list(self.tasks), timeout=SHUTDOWN_TIMEOUT)
+            if not self.connection.is_closed and not self.connection.is_closing:
+                self.connection.close()
+                await self.closed
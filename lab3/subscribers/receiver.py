@@ -1,31 +1,149 @@
+import argparse
+import asyncio
 import json
+from datetime import datetime
 
 from pika import BlockingConnection, ConnectionParameters, PlainCredentials
 from pika.exchange_type import ExchangeType
 
+from consumer import CONCURRENCY, MALFORMED, AsyncConsumer
+from segments import SEGMENT_SIZE, SegmentWriter
+
 RMQ_HOST = 'localhost'
 RMQ_USER = 'rabbit'
 RMQ_PASS = '1234'
 EXCHANGE_NAME = 'amq.topic'
 ROUTING_KEY = 'co2.*'
+# Durable work queue shared by all receivers: every reading goes to one of them, and unacknowledged
+# readings survive a crash of the receiver
+QUEUE_NAME = 'receiver'
+PREFETCH = 1000  # Unacknowledged messages the broker sends ahead
+FLUSH_RECORDS = 500  # Readings written to the log at once, should not exceed PREFETCH
+FLUSH_INTERVAL = 0.2  # Seconds after which a partial group is written anyway
+
+
+def status(data):
+    # Returns the line printed for a reading, raises one of MALFORMED if the reading can not be logged
+    datetime.fromisoformat(data['time'])
+    if not isinstance(data['value'], int):
+        raise TypeError(f"CO2 level {data['value']!r} is not an integer")
+    return f"{data['time']}: {'WARNING' if data['value'] > 500 else 'OK'}"
+
+
+class Receiver:
+    # Readings are acknowledged only once they are on disk, a crash makes the broker deliver them again
+    def __init__(self, channel, writer, flush_records=FLUSH_RECORDS):
+        self.channel = channel
+        self.writer = writer
+        self.flush_records = flush_records
+        self.last_tag = None
+
+    def callback(self, ch, method, properties, body):
+        try:
+            data = json.loads(body.decode())
+            line = status(data)
+            self.writer.append(data)
+        except MALFORMED as err:
+            # Delivering it again would fail again
+            print(f'Dropping a malformed message: {err}')
+            ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
+            return
+        self.last_tag = method.delivery_tag
+        print(line)
+
+        if self.writer.records >= self.flush_records:
+            self.flush()
+
+    def flush(self):
+        self.writer.flush()
+        if self.last_tag is not None:
+            # One ack for the whole group
+            self.channel.basic_ack(delivery_tag=self.last_tag, multiple=True)
+            self.last_tag = None
 
+    def flush_periodically(self):
+        self.flush()
+        self.channel.connection.call_later(FLUSH_INTERVAL, self.flush_periodically)
 
-def callback(ch, method, properties, body):
-    data = json.loads(body.decode())
-    with open('receiver.log', 'a') as f:
-        f.write(json.dumps(data) + '\n')
 
-    print(data['time'], end='')
-    print(': WARNING' if data['value'] > 500 else ': OK')
+class AsyncReceiver:
+    # Handler of the async mode. Readings of the concurrent handlers are written to the log together,
+    # every handler returns once its reading is on disk, so the consumer acks it only then
+    def __init__(self, writer, flush_records=FLUSH_RECORDS):
+        self.writer = writer
+        self.flush_records = flush_records
+        self.group = None  # Future resolved when the current group is on disk
+        self.timer = None
+
+    async def handle(self, body):
+        data = json.loads(body.decode())
+        print(status(data))
+
+        self.writer.append(data)
+        if self.group is None:
+            loop = asyncio.get_running_loop()
+            self.group = loop.create_future()
+            self.timer = loop.call_later(FLUSH_INTERVAL, self.flush)
+        group = self.group
+        if self.writer.records >= self.flush_records:
+            self.flush()
+        await group
+
+    def flush(self):
+        if self.group is None:
+            return
+        self.timer.cancel()
+        group, self.group = self.group, None
+        try:
+            self.writer.flush()
+        except OSError as err:
+            group.set_exception(err)
+        else:
+            group.set_result(None)
 
 
 if __name__ == '__main__':
-    connection = BlockingConnection(
-        ConnectionParameters(
-            host=RMQ_HOST,
-            credentials=PlainCredentials(RMQ_USER, RMQ_PASS)
-        )
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--shard', type=str, default='0',
+                        help='Name of the log shard of this receiver, every running receiver needs its own')
+    parser.add_argument('--binary', action='store_true', help='Writes readings as fixed-size binary records')
+    parser.add_argument('--prefetch', type=int, default=PREFETCH)
+    parser.add_argument('--flush-records', type=int, default=FLUSH_RECORDS)
+    parser.add_argument('--segment-size', type=int, default=SEGMENT_SIZE, help='Bytes per log segment')
+    parser.add_argument('--async', dest='async_mode', action='store_true',
+                        help='Consumes on an asyncio event loop with concurrent handlers')
+    parser.add_argument('--concurrency', type=int, default=CONCURRENCY, help='Handlers that run at the same time')
+    args = parser.parse_args()
+
+    parameters = ConnectionParameters(
+        host=RMQ_HOST,
+        credentials=PlainCredentials(RMQ_USER, RMQ_PASS)
     )
+    try:
+        writer = SegmentWriter(args.shard, args.binary, args.segment_size)
+    except ValueError as error:
+        print(error)
+        exit(1)
+
+    if args.async_mode:
+        # A group can not grow beyond the readings that are handled at the same time
+        receiver = AsyncReceiver(writer, min(args.flush_records, args.prefetch, args.concurrency))
+        consumer = AsyncConsumer(parameters, EXCHANGE_NAME, ROUTING_KEY, receiver.handle, queue=QUEUE_NAME,
+                                 durable=True, prefetch=args.prefetch, concurrency=args.concurrency)
+        print('[*] Waiting for CO2 data. Press CTRL+C to exit')
+        try:
+            asyncio.run(consumer.run())
+        except KeyboardInterrupt:
+            print('Received Interrupt. Exiting...')
+        except Exception:
+            # The unacknowledged readings are delivered again, writing them would log them twice
+            writer.discard()
+            raise
+        finally:
+            writer.close()
+        exit()
+
+    connection = BlockingConnection(parameters)
     channel = connection.channel()
 
     channel.exchange_declare(
@@ -34,7 +152,7 @@ if __name__ == '__main__':
         durable=True
     )
 
-    queue_name = channel.queue_declare(queue='', exclusive=True).method.queue
+    queue_name = channel.queue_declare(queue=QUEUE_NAME, durable=True).method.queue
 
     channel.queue_bind(
         exchange=EXCHANGE_NAME,
@@ -44,16 +162,24 @@ if __name__ == '__main__':
 
     print('[*] Waiting for CO2 data. Press CTRL+C to exit')
 
+    # A group is flushed before the broker stops sending, so the prefetch is never smaller than a group
+    receiver = Receiver(channel, writer, min(args.flush_records, args.prefetch))
+    channel.basic_qos(prefetch_count=args.prefetch)
     channel.basic_consume(
         queue=queue_name,
-        on_message_callback=callback,
-        auto_ack=True
+        on_message_callback=receiver.callback
     )
+    connection.call_later(FLUSH_INTERVAL, receiver.flush_periodically)
 
     try:
         channel.start_consuming()
     except KeyboardInterrupt:
         print('Received Interrupt. Exiting...')
+        receiver.flush()
         exit()
+    except Exception:
+        writer.discard()
+        raise
     finally:
+        writer.close()
         connection.close()
@@ -1,35 +1,248 @@
+import argparse
+import asyncio
 import json
+import os
+from collections import deque
 from datetime import datetime
 
 from pika import BlockingConnection, ConnectionParameters, PlainCredentials
 from pika.exchange_type import ExchangeType
 
+from consumer import AsyncConsumer
+from segments import list_segments, read_segments
+from tsdb import TimeSeriesStore
+
 RMQ_HOST = 'localhost'
 RMQ_USER = 'rabbit'
 RMQ_PASS = '1234'
 EXCHANGE_NAME = 'amq.topic'
 ROUTING_KEY = 'rep.*'
+CHECKPOINT_FILE = 'reporter.checkpoint'
+WINDOWS = [60, 300, 900]  # Seconds of the sliding-window averages
+UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+class SlidingWindow:
+    # Running count and sum of the readings of the last `seconds`, kept in one-second buckets
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.buckets = deque()  # [second, count, sum]
+        self.count = 0
+        self.total = 0
+
+    def add(self, second, value):
+        # A reading older than the newest bucket is counted in it, so the buckets stay in order
+        if self.buckets and self.buckets[-1][0] >= second:
+            self.buckets[-1][1] += 1
+            self.buckets[-1][2] += value
+        else:
+            self.buckets.append([second, 1, value])
+        self.count += 1
+        self.total += value
+        self.expire(second)
+
+    def expire(self, now):
+        while self.buckets and self.buckets[0][0] <= now - self.seconds:
+            _, count, total = self.buckets.popleft()
+            self.count -= count
+            self.total -= total
+
+    def average(self):
+        return self.total / self.count if self.count else None
+
+
+class Aggregates:
+    # Everything the queries need, updated once per reading
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        # Shard -> [segment, offset] up to which the readings of the shard are consumed
+        self.positions = {}
+        self.latest = None
+        self.latest_time = 0
+        self.count = 0
+        self.total = 0
+        self.windows = [SlidingWindow(seconds) for seconds in WINDOWS]
+        self.store_sizes = {}  # Rows of every partition of the time-series store that are covered
+
+    def update(self, reading, timestamp):
+        second = int(timestamp)
+        # Shards are read one after another, a shard may lag behind the others
+        if timestamp >= self.latest_time:
+            self.latest, self.latest_time = reading, timestamp
+        self.count += 1
+        self.total += reading['value']
+        for window in self.windows:
+            window.add(second, reading['value'])
+
+    def average(self):
+        return self.total / self.count if self.count else None
+
+    def save(self, file_name):
+        tmp_name = file_name + '.tmp'
+        with open(tmp_name, 'w') as f:
+            json.dump({
+                'positions': self.positions,
+                'latest': self.latest,
+                'latest_time': self.latest_time,
+                'count': self.count,
+                'total': self.total,
+                'windows': {window.seconds: list(window.buckets) for window in self.windows},
+                'store': self.store_sizes,
+            }, f)
+        os.replace(tmp_name, file_name)
+
+    @classmethod
+    def load(cls, file_name):
+        aggregates = cls()
+        try:
+            with open(file_name, 'r') as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return aggregates
+        if 'positions' not in state:
+            # A checkpoint of the log without shards, the log is read again
+            return aggregates
+
+        aggregates.positions = state['positions']
+        aggregates.latest, aggregates.latest_time = state['latest'], state['latest_time']
+        aggregates.count, aggregates.total = state['count'], state['total']
+        for window in aggregates.windows:
+            for second, count, total in state['windows'].get(str(window.seconds), []):
+                window.buckets.append([second, count, total])
+                window.count += count
+                window.total += total
+        aggregates.store_sizes = {int(partition): rows for partition, rows in state.get('store', {}).items()}
+        return aggregates
+
+
+def catch_up(aggregates):
+    # Reads only the readings that every receiver logged since the last query
+    segments = list_segments()
+    if not segments and aggregates.count:
+        # The log was removed, starting over
+        aggregates.reset()
+        store.truncate({})
+
+    readings = []
+    for shard in sorted({shard for shard, _, _ in segments}):
+        segment, offset = aggregates.positions.get(shard, (0, 0))
+        for reading, segment, offset in read_segments(shard, segment, offset):
+            readings.append((datetime.fromisoformat(reading['time']).timestamp(), reading))
+        aggregates.positions[shard] = [segment, offset]
+
+    # Merging the shards by the time of the readings
+    readings.sort(key=lambda item: item[0])
+    times, values = [], []
+    for timestamp, reading in readings:
+        aggregates.update(reading, timestamp)
+        times.append(timestamp)
+        values.append(reading['value'])
+    if times:
+        # The store is appended to before the checkpoint that covers the new rows
+        store.append(times, values)
+        aggregates.store_sizes = store.sizes()
+        aggregates.save(CHECKPOINT_FILE)
+
+
+def parse_duration(text):
+    # Seconds, optionally with a unit: 90, 15m, 2h
+    if text[-1] in UNITS:
+        return float(text[:-1]) * UNITS[text[-1]]
+    return float(text)
+
+
+def parse_time(text, now):
+    # 'now', a duration before now like -15m, or an ISO date and time
+    if text == 'now':
+        return now
+    if text.startswith('-'):
+        return now - parse_duration(text[1:])
+    return datetime.fromisoformat(text).timestamp()
+
+
+def answer_range(params):
+    # range <start> [<end>]: count, min, max and average over the time range
+    now = datetime.now().timestamp()
+    start = parse_time(params[0], now)
+    end = parse_time(params[1], now) if len(params) > 1 else now
+    count, low, high, average = store.summary(start, end)
+    print(f'{datetime.fromtimestamp(start).__str__()} - {datetime.fromtimestamp(end).__str__()}: '
+          f'{count} readings, min CO2 level is {low}, max is {high}, average is {average}')
+
+
+def answer_downsample(params):
+    # downsample <start> <end> <step>: the same per bucket of `step` seconds
+    now = datetime.now().timestamp()
+    start, end, step = parse_time(params[0], now), parse_time(params[1], now), parse_duration(params[2])
+    if step <= 0:
+        raise ValueError('Step has to be positive')
+    buckets = store.downsample(start, end, step)
+    if not buckets:
+        print(f'{datetime.fromtimestamp(start).__str__()} - {datetime.fromtimestamp(end).__str__()}: '
+              f'No CO2 readings')
+    for bucket, count, low, high, average in buckets:
+        print(f'{datetime.fromtimestamp(bucket).__str__()}: '
+              f'{count} readings, min CO2 level is {low}, max is {high}, average is {average}')
 
 
 def callback(ch, method, properties, body):
-    msg = body.decode()
-    with open('receiver.log', 'r') as f:
-        reports = list(map(lambda r: json.loads(r.strip()), f.readlines()))
+    msg, *params = body.decode().split()
+    catch_up(aggregates)
 
-    if msg == 'current':
-        print(f"{reports[-1]['time']}: Latest CO2 level is {reports[-1]['value']}")
+    if msg in ('range', 'downsample'):
+        try:
+            (answer_range if msg == 'range' else answer_downsample)(params)
+        except (ValueError, IndexError):
+            print(f'Invalid query: {body.decode()}')
+    elif aggregates.latest is None:
+        print(f'{datetime.now().__str__()}: No CO2 readings yet')
+    elif msg == 'current':
+        print(f"{aggregates.latest['time']}: Latest CO2 level is {aggregates.latest['value']}")
     else:
-        print(f"{datetime.now().__str__()}: "
-              f"Average CO2 level is {sum(map(lambda r: r['value'], reports)) / len(reports)}")
+        now = datetime.now()
+        print(f'{now.__str__()}: Average CO2 level is {aggregates.average()}')
+        for window in aggregates.windows:
+            window.expire(int(now.timestamp()))
+            if (average := window.average()) is not None:
+                print(f'{now.__str__()}: Average CO2 level over the last {window.seconds}s is {average}')
+
+
+async def handle(body):
+    # Handler of the async mode. Answering reads the log and scans the store, that runs on a thread
+    # so the event loop keeps receiving; queries are answered one at a time as they share the aggregates
+    async with query_lock:
+        await asyncio.get_running_loop().run_in_executor(None, callback, None, None, None, body)
 
 
 if __name__ == '__main__':
-    connection = BlockingConnection(
-        ConnectionParameters(
-            host=RMQ_HOST,
-            credentials=PlainCredentials(RMQ_USER, RMQ_PASS)
-        )
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--async', dest='async_mode', action='store_true',
+                        help='Consumes on an asyncio event loop, queries are answered on a thread')
+    args = parser.parse_args()
+
+    # Restarts continue from the checkpoint instead of reading the whole log again
+    aggregates = Aggregates.load(CHECKPOINT_FILE)
+    store = TimeSeriesStore()
+    store.truncate(aggregates.store_sizes)
+
+    parameters = ConnectionParameters(
+        host=RMQ_HOST,
+        credentials=PlainCredentials(RMQ_USER, RMQ_PASS)
     )
+
+    if args.async_mode:
+        query_lock = asyncio.Lock()
+        consumer = AsyncConsumer(parameters, EXCHANGE_NAME, ROUTING_KEY, handle)
+        print('[*] Waiting for queries from the control tower. Press CTRL+C to exit')
+        try:
+            asyncio.run(consumer.run())
+        except KeyboardInterrupt:
+            print('Received Interrupt. Exiting...')
+        exit()
+
+    connection = BlockingConnection(parameters)
     channel = connection.channel()
 
     channel.exchange_declare(
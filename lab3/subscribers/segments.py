@@ -0,0 +1,131 @@
+import fcntl
+import glob
+import json
+import os
+import re
+import struct
+from datetime import datetime
+
+LOG_NAME = 'receiver'
+SEGMENT_SIZE = 64 << 20  # A new segment is started once the current one reaches this size
+BINARY_RECORD = struct.Struct('<di')  # Unix time of the reading and the CO2 level
+SEGMENT_PATTERN = re.compile(rf'{LOG_NAME}-(\w+)-(\d+)\.(log|bin)$')
+SHARD_PATTERN = re.compile(r'[A-Za-z0-9_]+$')
+
+
+def segment_path(shard, number, binary):
+    # Every receiver writes its own shard of the log.
+    # JSON lines go to .log segments, fixed-size binary records to .bin segments
+    return f'{LOG_NAME}-{shard}-{number:06d}.{"bin" if binary else "log"}'
+
+
+def list_segments(shard=None):
+    # Returns (shard, number, path) of every segment (of the shard), the segments of a shard in the order
+    # they were written
+    segments = []
+    for path in glob.glob(f'{LOG_NAME}-{shard or "*"}-*.*'):
+        if match := SEGMENT_PATTERN.match(os.path.basename(path)):
+            segments.append((match.group(1), int(match.group(2)), path))
+    return sorted(segments)
+
+
+def encode(reading, binary):
+    if binary:
+        return BINARY_RECORD.pack(datetime.fromisoformat(reading['time']).timestamp(), reading['value'])
+    return (json.dumps(reading) + '\n').encode()
+
+
+class SegmentWriter:
+    # Appends readings to the shard of the log in groups: one write and one fsync per flush instead of an
+    # open, write and close per reading. Every run starts a new segment, so a segment never
+    # mixes encodings and a torn record of a crashed run is never appended to
+    def __init__(self, shard, binary=False, segment_size=SEGMENT_SIZE):
+        if not SHARD_PATTERN.match(shard):
+            raise ValueError(f'Shard name {shard} may only contain letters, digits and underscores')
+        # Segments are read in order, so only one receiver may write a shard
+        self.lock = open(f'{LOG_NAME}-{shard}.lock', 'w')
+        try:
+            fcntl.flock(self.lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self.lock.close()
+            raise ValueError(f'Shard {shard} is written by another receiver')
+
+        self.shard = shard
+        self.binary = binary
+        self.segment_size = segment_size
+        segments = list_segments(shard)
+        self.number = segments[-1][1] + 1 if segments else 1
+        self.file = None
+        self.size = 0
+        self.buffer = bytearray()
+        self.records = 0
+        self.open()
+
+    def open(self):
+        self.file = open(segment_path(self.shard, self.number, self.binary), 'ab', buffering=0)
+        self.size = self.file.tell()
+
+    def append(self, reading):
+        self.buffer += encode(reading, self.binary)
+        self.records += 1
+
+    def flush(self):
+        # Returns only once the buffered readings are on disk
+        if not self.buffer:
+            return
+        try:
+            written = self.file.write(self.buffer)
+            while written < len(self.buffer):
+                written += self.file.write(self.buffer[written:])
+            os.fsync(self.file.fileno())
+        except OSError:
+            # The readings were not acknowledged, the broker delivers them again. They are dropped,
+            # so they are not written twice, and a partial write is cut off, so no torn record is appended to
+            self.discard()
+            os.ftruncate(self.file.fileno(), self.size)
+            raise
+        self.size += len(self.buffer)
+        self.buffer.clear()
+        self.records = 0
+
+        if self.size >= self.segment_size:
+            self.file.close()
+            self.number += 1
+            self.open()
+
+    def discard(self):
+        # Drops the readings that were not written yet
+        self.buffer.clear()
+        self.records = 0
+
+    def close(self):
+        self.flush()
+        self.file.close()
+        self.lock.close()
+
+
+def read_segments(shard, number=0, offset=0):
+    # Yields every complete reading of the shard after the position (segment number, offset in it),
+    # together with the position right after the reading
+    for _, segment, path in list_segments(shard):
+        if segment < number:
+            continue
+        if segment > number:
+            number, offset = segment, 0
+
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            data = f.read()
+
+        if path.endswith('.bin'):
+            # A record that is still being written is left for the next read
+            data = data[:len(data) - len(data) % BINARY_RECORD.size]
+            for timestamp, value in BINARY_RECORD.iter_unpack(data):
+                offset += BINARY_RECORD.size
+                yield {'time': datetime.fromtimestamp(timestamp).__str__(), 'value': value}, number, offset
+        else:
+            for line in data.splitlines(keepends=True):
+                if not line.endswith(b'\n'):
+                    break
+                offset += len(line)
+                yield json.loads(line), number, offset
@@ -0,0 +1,98 @@
+import glob
+import os
+
+import numpy as np
+
+STORE_DIR = 'tsdb'
+PARTITION = 3600  # Seconds of readings per partition
+TIME_DTYPE = np.dtype('<f8')  # Unix time of the reading
+VALUE_DTYPE = np.dtype('<i4')  # CO2 level
+
+
+class TimeSeriesStore:
+    # Readings stored by columns: every partition is a pair of flat files with the times and the values,
+    # appended in arrival order and memory-mapped for queries
+    def __init__(self, directory=STORE_DIR):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, partition, column):
+        return os.path.join(self.directory, f'{partition}.{column}')
+
+    def partitions(self):
+        return sorted(int(os.path.basename(path).split('.')[0])
+                      for path in glob.glob(os.path.join(self.directory, '*.time')))
+
+    def append(self, times, values):
+        times = np.asarray(times, dtype=TIME_DTYPE)
+        values = np.asarray(values, dtype=VALUE_DTYPE)
+        partitions = (times // PARTITION).astype('int64') * PARTITION
+        for partition in np.unique(partitions):
+            selected = partitions == partition
+            for column, data in (('time', times[selected]), ('value', values[selected])):
+                with open(self.path(partition, column), 'ab') as f:
+                    f.write(data.tobytes())
+
+    def sizes(self):
+        # Rows of every partition, saved with the reporter checkpoint
+        return {partition: min(os.path.getsize(self.path(partition, column)) // dtype.itemsize
+                               for column, dtype in (('time', TIME_DTYPE), ('value', VALUE_DTYPE)))
+                for partition in self.partitions()}
+
+    def truncate(self, sizes):
+        # Drops the rows appended after the checkpoint, they are appended again from the log
+        for partition in self.partitions():
+            rows = sizes.get(partition, 0)
+            for column, dtype in (('time', TIME_DTYPE), ('value', VALUE_DTYPE)):
+                path = self.path(partition, column)
+                if not os.path.exists(path):
+                    continue
+                if rows == 0:
+                    os.remove(path)
+                elif os.path.getsize(path) > rows * dtype.itemsize:
+                    os.truncate(path, rows * dtype.itemsize)
+
+    def load(self, partition):
+        # Returns memory-mapped times and values of the partition
+        columns = []
+        for column, dtype in (('time', TIME_DTYPE), ('value', VALUE_DTYPE)):
+            path = self.path(partition, column)
+            rows = os.path.getsize(path) // dtype.itemsize if os.path.exists(path) else 0
+            columns.append(np.memmap(path, dtype=dtype, mode='r', shape=(rows,)) if rows else np.empty(0, dtype))
+        # A write of the other column may still be in progress
+        rows = min(map(len, columns))
+        return columns[0][:rows], columns[1][:rows]
+
+    def scan(self, start, end):
+        # Times and values of the readings in [start, end), only the partitions overlapping the range are read
+        times, values = [], []
+        for partition in self.partitions():
+            if partition + PARTITION <= start or partition >= end:
+                continue
+            partition_times, partition_values = self.load(partition)
+            selected = (partition_times >= start) & (partition_times < end)
+            times.append(partition_times[selected])
+            values.append(partition_values[selected])
+        if not times:
+            return np.empty(0, TIME_DTYPE), np.empty(0, VALUE_DTYPE)
+        return np.concatenate(times), np.concatenate(values)
+
+    def summary(self, start, end):
+        # Returns count, min, max and average of the readings in [start, end)
+        _, values = self.scan(start, end)
+        if not len(values):
+            return 0, None, None, None
+        return len(values), int(values.min()), int(values.max()), float(values.mean(dtype='float64'))
+
+    def downsample(self, start, end, step):
+        # Returns (bucket start, count, min, max, average) of every non-empty bucket of `step` seconds
+        times, values = self.scan(start, end)
+        buckets = ((times - start) // step).astype('int64')
+        count = np.bincount(buckets, minlength=1)
+        total = np.bincount(buckets, weights=values, minlength=1)
+        low = np.full(len(count), np.iinfo(VALUE_DTYPE).max, dtype='int64')
+        high = np.full(len(count), np.iinfo(VALUE_DTYPE).min, dtype='int64')
+        np.minimum.at(low, buckets, values)
+        np.maximum.at(high, buckets, values)
+        return [(start + i * step, int(count[i]), int(low[i]), int(high[i]), total[i] / count[i])
+                for i in np.flatnonzero(count)]
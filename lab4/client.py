@@ -10,15 +10,33 @@ def put_user(user_id, user_name):
     print(f"PutUser({user_id}, '{user_name}') = {response.status}")
 
 
-def get_users():
-    args = service.Empty()
-    response = stub.GetUsers(args)
+def get_users(page_size=0):
+    # Users arrive page by page
+    args = service.Cursor(page_size=page_size)
     result = {}
-    for user in response.users:
-        result[user.user_id] = user.user_name
+    for page in stub.GetUsers(args):
+        for user in page.users:
+            result[user.user_id] = user.user_name
     print(f"GetUsers() = {result}")
 
 
+def count_users(page_size=0):
+    args = service.Cursor(page_size=page_size)
+    count = sum(len(page.users) for page in stub.GetUsers(args))
+    print(f"GetUsers() returned {count} users")
+
+
+def put_users(users):
+    # One stream of users instead of a call per user
+    response = stub.PutUsers(service.User(user_id=user_id, user_name=user_name) for user_id, user_name in users)
+    print(f"PutUsers() = {response.status}, {response.count} users")
+
+
+def delete_users(user_ids):
+    response = stub.DeleteUsers(service.User(user_id=user_id) for user_id in user_ids)
+    print(f"DeleteUsers() = {response.status}, {response.count} users")
+
+
 def delete_user(user_id):
     args = service.User(user_id=user_id)
     response = stub.DeleteUser(args)
@@ -40,3 +58,9 @@ if __name__ == '__main__':
 
         # Retrieve all users
         get_users()
+
+        # Create, count and delete many users with the streaming calls
+        put_users((i, f"User{i}") for i in range(5, 100005))
+        count_users()
+        delete_users(range(5, 100005))
+        get_users()
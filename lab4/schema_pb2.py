@@ -1,11 +1,22 @@
 # -*- coding: utf-8 -*-
 # Generated by the protocol buffer compiler.  DO NOT EDIT!
+# NO CHECKED-IN PROTOBUF GENCODE
 # source: schema.proto
+# Protobuf Python Version: 7.35.1
 """Generated protocol buffer code."""
-from google.protobuf.internal import builder as _builder
 from google.protobuf import descriptor as _descriptor
 from google.protobuf import descriptor_pool as _descriptor_pool
+from google.protobuf import runtime_version as _runtime_version
 from google.protobuf import symbol_database as _symbol_database
+from google.protobuf.internal import builder as _builder
+_runtime_version.ValidateProtobufRuntimeVersion(
+    _runtime_version.Domain.PUBLIC,
+    7,
+    35,
+    1,
+    '',
+    'schema.proto'
+)
 # @@protoc_insertion_point(imports)
 
 _sym_db = _symbol_database.Default()
@@ -13,21 +24,25 @@ _sym_db = _symbol_database.Default()
 
 
 
-DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\x0cschema.proto\"\x07\n\x05\x45mpty\"=\n\x04User\x12\x0f\n\x07user_id\x18\x01 \x01(\r\x12\x16\n\tuser_name\x18\x02 \x01(\tH\x00\x88\x01\x01\x42\x0c\n\n_user_name\"\x1d\n\x05Users\x12\x14\n\x05users\x18\x01 \x03(\x0b\x32\x05.User\"\x1a\n\x08Response\x12\x0e\n\x06status\x18\x01 \x01(\x08\x32i\n\x08\x44\x61tabase\x12\x1d\n\x07PutUser\x12\x05.User\x1a\t.Response\"\x00\x12 \n\nDeleteUser\x12\x05.User\x1a\t.Response\"\x00\x12\x1c\n\x08GetUsers\x12\x06.Empty\x1a\x06.Users\"\x00\x62\x06proto3')
-
-_builder.BuildMessageAndEnumDescriptors(DESCRIPTOR, globals())
-_builder.BuildTopDescriptorsAndMessages(DESCRIPTOR, 'schema_pb2', globals())
-if _descriptor._USE_C_DESCRIPTORS == False:
+DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\x0cschema.proto\"\x07\n\x05\x45mpty\"=\n\x04User\x12\x0f\n\x07user_id\x18\x01 \x01(\r\x12\x16\n\tuser_name\x18\x02 \x01(\tH\x00\x88\x01\x01\x42\x0c\n\n_user_name\"\x1d\n\x05Users\x12\x14\n\x05users\x18\x01 \x03(\x0b\x32\x05.User\"]\n\x06\x43ursor\x12\x1a\n\rafter_user_id\x18\x01 \x01(\rH\x00\x88\x01\x01\x12\x11\n\tpage_size\x18\x02 \x01(\r\x12\x12\n\npage_limit\x18\x03 \x01(\rB\x10\n\x0e_after_user_id\"\x1a\n\x08Response\x12\x0e\n\x06status\x18\x01 \x01(\x08\"-\n\x0c\x42ulkResponse\x12\x0e\n\x06status\x18\x01 \x01(\x08\x12\r\n\x05\x63ount\x18\x02 \x01(\r2\xbb\x01\n\x08\x44\x61tabase\x12\x1d\n\x07PutUser\x12\x05.User\x1a\t.Response\"\x00\x12 \n\nDeleteUser\x12\x05.User\x1a\t.Response\"\x00\x12\x1f\n\x08GetUsers\x12\x07.Cursor\x1a\x06.Users\"\x00\x30\x01\x12$\n\x08PutUsers\x12\x05.User\x1a\r.BulkResponse\"\x00(\x01\x12\'\n\x0b\x44\x65leteUsers\x12\x05.User\x1a\r.BulkResponse\"\x00(\x01\x62\x06proto3')
 
-  DESCRIPTOR._options = None
-  _EMPTY._serialized_start=16
-  _EMPTY._serialized_end=23
-  _USER._serialized_start=25
-  _USER._serialized_end=86
-  _USERS._serialized_start=88
-  _USERS._serialized_end=117
-  _RESPONSE._serialized_start=119
-  _RESPONSE._serialized_end=145
-  _DATABASE._serialized_start=147
-  _DATABASE._serialized_end=252
+_globals = globals()
+_builder.BuildMessageAndEnumDescriptors(DESCRIPTOR, _globals)
+_builder.BuildTopDescriptorsAndMessages(DESCRIPTOR, 'schema_pb2', _globals)
+if not _descriptor._USE_C_DESCRIPTORS:
+  DESCRIPTOR._loaded_options = None
+  _globals['_EMPTY']._serialized_start=16
+  _globals['_EMPTY']._serialized_end=23
+  _globals['_USER']._serialized_start=25
+  _globals['_USER']._serialized_end=86
+  _globals['_USERS']._serialized_start=88
+  _globals['_USERS']._serialized_end=117
+  _globals['_CURSOR']._serialized_start=119
+  _globals['_CURSOR']._serialized_end=212
+  _globals['_RESPONSE']._serialized_start=214
+  _globals['_RESPONSE']._serialized_end=240
+  _globals['_BULKRESPONSE']._serialized_start=242
+  _globals['_BULKRESPONSE']._serialized_end=287
+  _globals['_DATABASE']._serialized_start=290
+  _globals['_DATABASE']._serialized_end=477
 # @@protoc_insertion_point(module_scope)
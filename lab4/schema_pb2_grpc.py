@@ -1,11 +1,31 @@
 # Generated by the gRPC Python protocol compiler plugin. DO NOT EDIT!
 """Client and server classes corresponding to protobuf-defined services."""
 import grpc
+import warnings
 
 import schema_pb2 as schema__pb2
 
+GRPC_GENERATED_VERSION = '1.84.0'
+GRPC_VERSION = grpc.__version__
+_version_not_supported = False
 
-class DatabaseStub(object):
+try:
+    from grpc._utilities import first_version_is_lower
+    _version_not_supported = first_version_is_lower(GRPC_VERSION, GRPC_GENERATED_VERSION)
+except ImportError:
+    _version_not_supported = True
+
+if _version_not_supported:
+    raise RuntimeError(
+        f'The grpc package installed is at version {GRPC_VERSION},'
+        + ' but the generated code in schema_pb2_grpc.py depends on'
+        + f' grpcio>={GRPC_GENERATED_VERSION}.'
+        + f' Please upgrade your grpc module to grpcio>={GRPC_GENERATED_VERSION}'
+        + f' or downgrade your generated code using grpcio-tools<={GRPC_VERSION}.'
+    )
+
+
+class DatabaseStub:
     """Missing associated documentation comment in .proto file."""
 
     def __init__(self, channel):
@@ -18,20 +38,30 @@ class DatabaseStub(object):
                 '/Database/PutUser',
                 request_serializer=schema__pb2.User.SerializeToString,
                 response_deserializer=schema__pb2.Response.FromString,
-                )
+                _registered_method=True)
         self.DeleteUser = channel.unary_unary(
                 '/Database/DeleteUser',
                 request_serializer=schema__pb2.User.SerializeToString,
                 response_deserializer=schema__pb2.Response.FromString,
-                )
-        self.GetUsers = channel.unary_unary(
+                _registered_method=True)
+        self.GetUsers = channel.unary_stream(
                 '/Database/GetUsers',
-                request_serializer=schema__pb2.Empty.SerializeToString,
+                request_serializer=schema__pb2.Cursor.SerializeToString,
                 response_deserializer=schema__pb2.Users.FromString,
-                )
+                _registered_method=True)
+        self.PutUsers = channel.stream_unary(
+                '/Database/PutUsers',
+                request_serializer=schema__pb2.User.SerializeToString,
+                response_deserializer=schema__pb2.BulkResponse.FromString,
+                _registered_method=True)
+        self.DeleteUsers = channel.stream_unary(
+                '/Database/DeleteUsers',
+                request_serializer=schema__pb2.User.SerializeToString,
+                response_deserializer=schema__pb2.BulkResponse.FromString,
+                _registered_method=True)
 
 
-class DatabaseServicer(object):
+class DatabaseServicer:
     """Missing associated documentation comment in .proto file."""
 
     def PutUser(self, request, context):
@@ -47,6 +77,20 @@ class DatabaseServicer(object):
         raise NotImplementedError('Method not implemented!')
 
     def GetUsers(self, request, context):
+        """Users in the order of their ids, one page per message
+        """
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def PutUsers(self, request_iterator, context):
+        """Users are applied in batched transactions
+        """
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def DeleteUsers(self, request_iterator, context):
         """Missing associated documentation comment in .proto file."""
         context.set_code(grpc.StatusCode.UNIMPLEMENTED)
         context.set_details('Method not implemented!')
@@ -65,19 +109,30 @@ def add_DatabaseServicer_to_server(servicer, server):
                     request_deserializer=schema__pb2.User.FromString,
                     response_serializer=schema__pb2.Response.SerializeToString,
             ),
-            'GetUsers': grpc.unary_unary_rpc_method_handler(
+            'GetUsers': grpc.unary_stream_rpc_method_handler(
                     servicer.GetUsers,
-                    request_deserializer=schema__pb2.Empty.FromString,
+                    request_deserializer=schema__pb2.Cursor.FromString,
                     response_serializer=schema__pb2.Users.SerializeToString,
             ),
+            'PutUsers': grpc.stream_unary_rpc_method_handler(
+                    servicer.PutUsers,
+                    request_deserializer=schema__pb2.User.FromString,
+                    response_serializer=schema__pb2.BulkResponse.SerializeToString,
+            ),
+            'DeleteUsers': grpc.stream_unary_rpc_method_handler(
+                    servicer.DeleteUsers,
+                    request_deserializer=schema__pb2.User.FromString,
+                    response_serializer=schema__pb2.BulkResponse.SerializeToString,
+            ),
     }
     generic_handler = grpc.method_handlers_generic_handler(
             'Database', rpc_method_handlers)
     server.add_generic_rpc_handlers((generic_handler,))
+    server.add_registered_method_handlers('Database', rpc_method_handlers)
 
 
  # This class is part of an EXPERIMENTAL API.
-class Database(object):
+class Database:
     """Missing associated documentation comment in .proto file."""
 
     @staticmethod
@@ -91,11 +146,21 @@ class Database(object):
             wait_for_ready=None,
             timeout=None,
             metadata=None):
-        return grpc.experimental.unary_unary(request, target, '/Database/PutUser',
+        return grpc.experimental.unary_unary(
+            request,
+            target,
+            '/Database/PutUser',
             schema__pb2.User.SerializeToString,
             schema__pb2.Response.FromString,
-            options, channel_credentials,
-            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
 
     @staticmethod
     def DeleteUser(request,
@@ -108,11 +173,21 @@ class Database(object):
             wait_for_ready=None,
             timeout=None,
             metadata=None):
-        return grpc.experimental.unary_unary(request, target, '/Database/DeleteUser',
+        return grpc.experimental.unary_unary(
+            request,
+            target,
+            '/Database/DeleteUser',
             schema__pb2.User.SerializeToString,
             schema__pb2.Response.FromString,
-            options, channel_credentials,
-            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
 
     @staticmethod
     def GetUsers(request,
@@ -125,8 +200,72 @@ class Database(object):
             wait_for_ready=None,
             timeout=None,
             metadata=None):
-        return grpc.experimental.unary_unary(request, target, '/Database/GetUsers',
-            schema__pb2.Empty.SerializeToString,
+        return grpc.experimental.unary_stream(
+            request,
+            target,
+            '/Database/GetUsers',
+            schema__pb2.Cursor.SerializeToString,
             schema__pb2.Users.FromString,
-            options, channel_credentials,
-            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
+
+    @staticmethod
+    def PutUsers(request_iterator,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.stream_unary(
+            request_iterator,
+            target,
+            '/Database/PutUsers',
+            schema__pb2.User.SerializeToString,
+            schema__pb2.BulkResponse.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
+
+    @staticmethod
+    def DeleteUsers(request_iterator,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.stream_unary(
+            request_iterator,
+            target,
+            '/Database/DeleteUsers',
+            schema__pb2.User.SerializeToString,
+            schema__pb2.BulkResponse.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
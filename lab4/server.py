@@ -1,40 +1,89 @@
+import argparse
 import sqlite3
+import threading
 from concurrent.futures import ThreadPoolExecutor
 from contextlib import closing
+from itertools import islice
 import grpc
 
 import schema_pb2 as stub
 import schema_pb2_grpc as service
 
 SERVER_ADDR = '0.0.0.0:1234'
+DB_NAME = 'db.sql'
+MAX_WORKERS = 10
+SYNCHRONOUS_MODES = ['OFF', 'NORMAL', 'FULL', 'EXTRA']
+SYNCHRONOUS = 'NORMAL'  # In WAL mode a power loss can only lose the last commits, it can not corrupt the database
+BUSY_TIMEOUT = 5000  # Milliseconds a connection waits for a lock held by another connection
+PAGE_SIZE = 1000  # Users per GetUsers message if the client does not ask for another size
+MAX_PAGE_SIZE = 10000
+BATCH_SIZE = 1000  # Users applied in one transaction by PutUsers and DeleteUsers
+
+# Constant statements with parameters: the text never changes, so every call reuses the statement compiled
+# by the first one (sqlite3 caches them per connection), and user names can not inject SQL
+UPSERT_USER = ('INSERT INTO Users(user_id, user_name) VALUES (?, ?) '
+               'ON CONFLICT(user_id) DO UPDATE SET user_name=excluded.user_name')
+DELETE_USER = 'DELETE FROM Users WHERE user_id=?'
+SELECT_USERS = 'SELECT user_id, user_name FROM Users WHERE user_id > ? ORDER BY user_id LIMIT ?'
+
+
+def batches(iterator, size):
+    while batch := list(islice(iterator, size)):
+        yield batch
 
 
 class Database(service.DatabaseServicer):
-    def __init__(self, db_name):
-        self.conn = sqlite3.connect(db_name, check_same_thread=False)
-        self.conn.row_factory = sqlite3.Row
+    def __init__(self, db_name, synchronous=SYNCHRONOUS, busy_timeout=BUSY_TIMEOUT):
+        if synchronous.upper() not in SYNCHRONOUS_MODES:
+            raise ValueError(f'synchronous must be one of {", ".join(SYNCHRONOUS_MODES)}')
+        self.db_name = db_name
+        self.synchronous = synchronous.upper()
+        self.busy_timeout = busy_timeout
+        self.local = threading.local()
+        self.connections = []
+        self.connections_lock = threading.Lock()
+
+        # WAL is a property of the database file: readers see the last commit while a writer appends to the log,
+        # so they do not wait for writers and writers do not wait for them
+        self.conn.execute('PRAGMA journal_mode=WAL')
         with closing(self.conn.cursor()) as cur:
             cur.execute('DROP TABLE IF EXISTS Users;')
             cur.execute('CREATE TABLE Users('
                         'user_id integer PRIMARY KEY, '
                         'user_name text NOT NULL);')
 
+    @property
+    def conn(self):
+        # Every worker thread of the server has its own connection, opened by its first call.
+        # Writes still take turns on the database lock, waiting up to busy_timeout for it
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            # Only used by its thread, close() runs once the server stopped
+            conn = sqlite3.connect(self.db_name, check_same_thread=False, timeout=self.busy_timeout / 1000)
+            conn.row_factory = sqlite3.Row
+            conn.execute(f'PRAGMA synchronous={self.synchronous}')
+            conn.execute(f'PRAGMA busy_timeout={self.busy_timeout}')
+            self.local.conn = conn
+            with self.connections_lock:
+                self.connections.append(conn)
+        return conn
+
+    def close(self):
+        with self.connections_lock:
+            for conn in self.connections:
+                conn.close()
+            self.connections.clear()
+
     def __del__(self):
-        self.conn.close()
+        self.close()
 
     def PutUser(self, request, context):
         user_id, user_name = request.user_id, request.user_name
         print(f'PutUser({user_id}, \'{user_name}\')')
         try:
-            with closing(self.conn.cursor()) as cur:
-                cur.execute(f'SELECT * FROM Users WHERE user_id={user_id} LIMIT 1')
-
-                if len(cur.fetchall()):
-                    cur.execute(f'UPDATE Users SET user_name=\'{user_name}\' WHERE user_id={user_id}')
-                else:
-                    cur.execute(f'INSERT INTO Users(user_id, user_name) VALUES ({user_id}, \'{user_name}\')')
-
-                self.conn.commit()
+            # One statement inserts a new user or renames an existing one
+            with self.conn:
+                self.conn.execute(UPSERT_USER, (user_id, user_name))
 
             return stub.Response(status=True)
         except sqlite3.Error as e:
@@ -42,29 +91,74 @@ class Database(service.DatabaseServicer):
             return stub.Response(status=False)
 
     def GetUsers(self, request, context):
+        # Keyset pagination: every page continues after the last id of the previous one,
+        # so each page is a range scan of the primary key however deep into the table it is
+        page_size = min(request.page_size or PAGE_SIZE, MAX_PAGE_SIZE)
+        after_user_id = request.after_user_id if request.HasField('after_user_id') else -1
+        pages = 0
         try:
             with closing(self.conn.cursor()) as cur:
-                cur.execute('SELECT user_id, user_name FROM Users;')
-                users = [dict(r) for r in cur.fetchall()]
-                return stub.Users(users=users)
+                while not request.page_limit or pages < request.page_limit:
+                    cur.execute(SELECT_USERS, (after_user_id, page_size))
+                    users = [dict(r) for r in cur.fetchall()]
+                    if not users:
+                        break
+                    yield stub.Users(users=users)
+                    after_user_id = users[-1]['user_id']
+                    pages += 1
         except sqlite3.Error as e:
-            return stub.Users(users=[])
+            print(e)
+            # Ending the stream normally would pass the pages sent so far off as all users
+            context.abort(grpc.StatusCode.INTERNAL, str(e))
 
     def DeleteUser(self, request, context):
         print(f'DeleteUser({request.user_id})')
         try:
-            with closing(self.conn.cursor()) as cur:
-                cur.execute(f'DELETE FROM Users WHERE user_id={request.user_id}')
-            self.conn.commit()
+            with self.conn:
+                self.conn.execute(DELETE_USER, (request.user_id,))
 
             return stub.Response(status=True)
         except sqlite3.Error as e:
             return stub.Response(status=False)
 
+    def apply_batches(self, request_iterator, statement, params):
+        # Runs the statement for every streamed user, one transaction per batch.
+        # Returns the number of applied users and whether all of them were applied
+        count = 0
+        try:
+            for batch in batches(request_iterator, BATCH_SIZE):
+                with self.conn:
+                    self.conn.executemany(statement, map(params, batch))
+                count += len(batch)
+            return count, True
+        except sqlite3.Error as e:
+            print(e)
+            return count, False
+
+    def PutUsers(self, request_iterator, context):
+        count, status = self.apply_batches(request_iterator, UPSERT_USER, lambda user: (user.user_id, user.user_name))
+        print(f'PutUsers() applied {count} users')
+        return stub.BulkResponse(status=status, count=count)
+
+    def DeleteUsers(self, request_iterator, context):
+        count, status = self.apply_batches(request_iterator, DELETE_USER, lambda user: (user.user_id,))
+        print(f'DeleteUsers() applied {count} users')
+        return stub.BulkResponse(status=status, count=count)
+
 
 if __name__ == '__main__':
-    server = grpc.server(ThreadPoolExecutor(max_workers=10))
-    service.add_DatabaseServicer_to_server(Database('db.sql'), server)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--db', type=str, default=DB_NAME)
+    parser.add_argument('--workers', type=int, default=MAX_WORKERS, help='Threads handling calls, one connection each')
+    parser.add_argument('--synchronous', type=str.upper, choices=SYNCHRONOUS_MODES, default=SYNCHRONOUS,
+                        help='How often SQLite syncs the database to disk, OFF is fastest and FULL is safest')
+    parser.add_argument('--busy-timeout', type=int, default=BUSY_TIMEOUT,
+                        help='Milliseconds a write waits for another one to finish before failing')
+    args = parser.parse_args()
+
+    database = Database(args.db, args.synchronous, args.busy_timeout)
+    server = grpc.server(ThreadPoolExecutor(max_workers=args.workers))
+    service.add_DatabaseServicer_to_server(database, server)
     server.add_insecure_port(SERVER_ADDR)
     server.start()
 
@@ -72,3 +166,5 @@ if __name__ == '__main__':
         server.wait_for_termination()
     except KeyboardInterrupt:
         print('Shutting down...')
+        server.stop(None)
+        database.close()